@@ -0,0 +1,51 @@
+"""Benchmarks of the kernel side: importing, the magics and `post`."""
+from IPython.core import magic_arguments
+
+import jupyterpost
+from jupyterpost.client import JupyterpostMagics
+
+from import_time import SERVICE_MODULES, import_time
+
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(1024**2)
+
+
+def bench_import(benchmark):
+    seconds, modules = benchmark.pedantic(
+        import_time, args=("import jupyterpost",), rounds=5
+    )
+    benchmark.extra_info["import_seconds"] = seconds
+    benchmark.extra_info["modules"] = len(modules)
+    assert not [m for m in modules if m.startswith(SERVICE_MODULES)]
+
+
+def bench_load_ipython_extension(benchmark, shell, allocations):
+    benchmark(jupyterpost.load_ipython_extension, shell)
+    allocations(jupyterpost.load_ipython_extension, shell)
+
+
+def bench_parse_magic_arguments(benchmark, allocations):
+    line = "-b -c @someone Training done --url http://localhost/ --token abc"
+    args = benchmark(
+        magic_arguments.parse_argstring, JupyterpostMagics.post, line
+    )
+    allocations(magic_arguments.parse_argstring, JupyterpostMagics.post, line)
+    assert args.channel == "@someone" and args.background
+
+
+def bench_post_message(benchmark, service_url, allocations):
+    kwargs = dict(service_url=service_url, token="token")
+    result = benchmark(jupyterpost.post, "Training done", "town-square", **kwargs)
+    allocations(jupyterpost.post, "Training done", "town-square", **kwargs)
+    assert result == {"post_id": "stub"}
+
+
+def bench_post_attachment(benchmark, service_url, allocations):
+    kwargs = dict(attachment=PNG, service_url=service_url, token="token")
+    benchmark(jupyterpost.post, "Training done", "town-square", **kwargs)
+    allocations(jupyterpost.post, "Training done", "town-square", **kwargs)
+
+
+def bench_post_line_magic(benchmark, shell, service_url):
+    jupyterpost.load_ipython_extension(shell)
+    line = f"town-square Training done --url {service_url} --token token"
+    benchmark(shell.run_line_magic, "post", line)
@@ -0,0 +1,41 @@
+"""Benchmarks of the service side against a fake Mattermost."""
+PNG = b"\x89PNG\r\n\x1a\n" + bytes(1024**2)
+
+
+def bench_hub_post_message(benchmark, service, loop, allocations):
+    def run():
+        return loop.run_until_complete(
+            service.hub_post_message("Training done", "town-square")
+        )
+
+    assert benchmark(run)["id"].startswith("post-")
+    allocations(run)
+
+
+def bench_hub_post_direct_message(benchmark, service, loop, allocations):
+    def run():
+        return loop.run_until_complete(
+            service.hub_post_message("Training done", "@someone")
+        )
+
+    assert benchmark(run)["id"].startswith("post-")
+    allocations(run)
+
+
+def bench_hub_post_attachments(benchmark, service, loop, allocations):
+    def run():
+        return loop.run_until_complete(
+            service.hub_post_message("Training done", "town-square", [PNG] * 4)
+        )
+
+    benchmark(run)
+    allocations(run)
+
+
+def bench_resolve_channel_id_cached(benchmark, service, loop):
+    loop.run_until_complete(service.resolve_channel_id("town-square"))
+
+    def run():
+        return loop.run_until_complete(service.resolve_channel_id("town-square"))
+
+    assert benchmark(run).startswith("channel-")
@@ -0,0 +1,102 @@
+"""Fixtures for the jupyterpost benchmarks.
+
+Requires pytest-benchmark. Posts go to a stub service running in a thread and
+the service side talks to the fake Mattermost of `jupyterpost.fake_mattermost`,
+so no network access is needed.
+"""
+import asyncio
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import json
+import os
+import threading
+import tracemalloc
+
+import pytest
+
+from jupyterpost import fake_mattermost, loadtest
+
+# Rate limits are lifted so that they do not dominate the timings. The URL is
+# replaced by the one of the fake Mattermost, see `service`.
+loadtest.configure_service("http://127.0.0.1:1/api/v4/")
+
+
+class _StubServiceHandler(BaseHTTPRequestHandler):
+    """Accept every post like the jupyterpost service does, without posting."""
+
+    protocol_version = "HTTP/1.1"
+    # Otherwise small responses wait for delayed acknowledgements
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"post_id": "stub"}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope="session")
+def service_url():
+    """The URL of a stub jupyterpost service."""
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _StubServiceHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}/services/jupyterpost/"
+    server.shutdown()
+
+
+@pytest.fixture(scope="session")
+def shell():
+    """An IPython shell without a terminal."""
+    from IPython.core.interactiveshell import InteractiveShell
+
+    return InteractiveShell.instance()
+
+
+@pytest.fixture(scope="session")
+def loop():
+    loop = asyncio.new_event_loop()
+    yield loop
+    loop.close()
+
+
+@pytest.fixture(scope="session")
+def service(loop):
+    """The service module, talking to a fake Mattermost served by loop."""
+    from jupyterpost import jupyterpost
+
+    async def start():
+        return loadtest.listen(fake_mattermost.make_app())
+
+    mattermost, url = loop.run_until_complete(start())
+    os.environ["MATTERMOST_URL"] = url + "/api/v4/"
+    yield jupyterpost
+    loop.run_until_complete(jupyterpost.close_mm_client())
+    mattermost.stop()
+
+
+@pytest.fixture
+def allocations(benchmark):
+    """Record the peak and retained memory of one call in the benchmark results.
+
+    Use as ``allocations(func, *args)`` in addition to benchmarking func.
+    """
+
+    def measure(func, *args, **kwargs):
+        tracemalloc.start()
+        try:
+            func(*args, **kwargs)
+            snapshot = tracemalloc.take_snapshot()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        stats = snapshot.statistics("filename")
+        benchmark.extra_info["retained_blocks"] = sum(s.count for s in stats)
+        benchmark.extra_info["peak_allocated_bytes"] = peak
+
+    return measure
@@ -0,0 +1,64 @@
+"""Measure how long importing jupyterpost takes in a fresh interpreter.
+
+Kernels only need the client side, ``import jupyterpost``, while the service
+side, ``jupyterpost.jupyterpost``, also loads JupyterHub and Tornado's server.
+Run with ``python benchmarks/import_time.py`` from the repository root.
+"""
+import argparse
+import re
+import statistics
+import subprocess
+import sys
+
+STATEMENTS = {
+    "kernel": "import jupyterpost",
+    "service": "import jupyterpost.jupyterpost",
+}
+# Modules that must not be loaded by the kernel side
+SERVICE_MODULES = ("jupyterhub", "tornado.httpserver", "jupyterpost.jupyterpost")
+
+
+def import_time(statement):
+    """Return the seconds the imports of statement take, and the modules loaded.
+
+    Uses ``python -X importtime`` in a new interpreter, so that nothing is
+    imported already.
+    """
+    code = f"{statement}\nimport sys\nprint(*sys.modules, sep='\\n')"
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = 0
+    for line in result.stderr.splitlines():
+        # Lines are "import time: self [us] | cumulative | package", nested
+        # imports are indented and already included in the cumulative time.
+        match = re.match(r"import time:\s+\d+ \|\s+(\d+) \| \S", line)
+        if match:
+            total += int(match.group(1))
+    return total / 1e6, result.stdout.split()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--repeat", type=int, default=5)
+    args = parser.parse_args()
+    for name, statement in STATEMENTS.items():
+        times = []
+        for _ in range(args.repeat):
+            seconds, modules = import_time(statement)
+            times.append(seconds)
+        print(
+            f"{name:8} {statement:34} median {statistics.median(times) * 1e3:7.1f} ms"
+            f"  min {min(times) * 1e3:7.1f} ms  {len(modules)} modules"
+        )
+        if name == "kernel":
+            loaded = [m for m in modules if m.startswith(SERVICE_MODULES)]
+            if loaded:
+                print(f"  kernel import loads service modules: {', '.join(loaded)}")
+
+
+if __name__ == "__main__":
+    main()
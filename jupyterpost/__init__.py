@@ -2,8 +2,30 @@
 
 __version__ = "0.0.2"
 
-from .jupyterpost import configure_jupyterhub, hub_post_message, main
-from .client import post, load_ipython_extension
+from .client import (
+    post,
+    apost,
+    post_in_background,
+    post_many,
+    post_status,
+    load_ipython_extension,
+)
+
+# The service side needs JupyterHub and Tornado's server, which are slow to
+# import and not needed in kernels, so it is only imported when used.
+_SERVICE_NAMES = {"configure_jupyterhub", "hub_post_message", "main"}
+
+
+def __getattr__(name):
+    if name in _SERVICE_NAMES:
+        from . import jupyterpost
+
+        return getattr(jupyterpost, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(set(__all__) | set(globals()))
 
 
 __all__ = [
@@ -11,5 +33,9 @@ __all__ = [
     "hub_post_message",
     "main",
     "post",
+    "apost",
+    "post_in_background",
+    "post_many",
+    "post_status",
     "load_ipython_extension",
 ]
@@ -0,0 +1,59 @@
+"""Small in-memory caches used by the JupyterPost service."""
+from collections import OrderedDict
+import time
+
+MISSING = object()
+
+
+class TTLCache:
+    """A least recently used cache whose entries expire after a while.
+
+    Parameters
+    ----------
+    maxsize : int
+        The maximum number of entries to keep. The least recently used entry is
+        evicted when the cache is full.
+    ttl : float
+        Seconds after which an entry expires.
+    """
+
+    def __init__(self, maxsize=1024, ttl=600):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+
+    def get(self, key, default=MISSING):
+        """Return the value stored under key, or default if absent or expired."""
+        try:
+            value, expires = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires < time.monotonic():
+            del self._data[key]
+            self.misses += 1
+            return default
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """Store value under key, optionally with a custom time to live."""
+        ttl = self.ttl if ttl is None else ttl
+        self._data[key] = (value, time.monotonic() + ttl)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def pop(self, key):
+        """Remove key from the cache if it is present."""
+        self._data.pop(key, None)
+
+    def clear(self):
+        """Remove all entries from the cache."""
+        self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
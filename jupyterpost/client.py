@@ -1,55 +1,426 @@
 from io import BytesIO
+import asyncio
 import os
-from base64 import b64decode
+import random
+from base64 import b64decode, b64encode
+from concurrent.futures import ThreadPoolExecutor
+import threading
+import time
+import uuid
 
 import httpx
 from IPython.core.magic import Magics, magics_class, line_cell_magic
 from IPython.core import magic_arguments
 from IPython import get_ipython
+from IPython.display import display
 from IPython.utils.capture import capture_output
 
+from .images import rasterize_svg, transcode
 
-def post(message, channel, attachment=None, service_url=None, token=None):
-    """Post a message to Mattermost using the JupyterHub service.
+# Mattermost refuses posts with more files than this.
+MAX_ATTACHMENTS = 10
 
-    Parameters
-    ----------
-    message : str
-        The message to post.
-    channel : str
-        The channel to post to. If it starts with '@', it is assumed to be a
-        direct message to the user with that username.
-    attachment : bytes or matplotlib figure, optional
-        A png file to upload. If given, will be attached to the message.
-    service_url : str, optional
-        The URL of the JupyterHub service. If not given, will be taken from the
-        JUPYTERPOST_URL environment variable.
-    token : str, optional
-        The API token to use. If not given, will be taken from the
-        JPY_API_TOKEN environment variable.
+# Worker for posts that should not block the kernel, see `post_in_background`.
+_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jupyterpost")
+
+# Connection pool to the service, see `_get_client`.
+_client = None
+_client_token = None
+_client_lock = threading.Lock()
+
+
+def _get_client(token):
+    """Return a client that keeps connections to the service alive.
+
+    The client is recreated when a different token is used, so that cookies
+    set for one user are not sent on behalf of another.
+    """
+    global _client, _client_token
+    with _client_lock:
+        if _client is None or _client_token != token:
+            if _client is not None:
+                _client.close()
+            _client = httpx.Client()
+            _client_token = token
+        return _client
+
+
+def _reset_after_fork():
+    """Drop the client and the worker in a forked child.
+
+    The connections of the client belong to the parent, and the thread of
+    the worker does not exist in the child, so posts submitted to it would
+    never run.
+    """
+    global _client, _client_token, _client_lock, _executor
+    _client = _client_token = None
+    _client_lock = threading.Lock()
+    _executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="jupyterpost")
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+
+# Failed requests to the service are retried after RETRY_BACKOFF seconds,
+# doubling after every further failure. Requests the service asks to retry
+# later than MAX_RETRY_WAIT seconds are not retried.
+RETRY_BACKOFF = 0.5
+MAX_RETRY_WAIT = 10
+
+
+def _retry_wait(attempt, response=None):
+    """Return the seconds to wait before retrying a request, or None not to.
+
+    response is None if the request failed without a response.
+    """
+    backoff = RETRY_BACKOFF * 2**attempt * random.uniform(1, 1.5)
+    if response is None or response.status_code >= 500:
+        return backoff
+    if response.status_code == 429:
+        try:
+            wait = float(response.headers["Retry-After"])
+        except (KeyError, ValueError):
+            wait = backoff
+        return wait if wait <= MAX_RETRY_WAIT else None
+    return None
+
+
+# Errors after which a request may be sent again
+_RETRY_ERRORS = (httpx.TimeoutException, httpx.NetworkError, httpx.RemoteProtocolError)
+
+
+def _send(client, retries, **kwargs):
+    """Post to the service, retrying failures, and return the result.
+
+    Retrying is safe because the request carries an idempotency key, so the
+    service does not post again if it already did.
     """
+    for attempt in range(retries + 1):
+        try:
+            response = client.post(**kwargs)
+        except _RETRY_ERRORS:
+            if attempt == retries:
+                raise
+            time.sleep(_retry_wait(attempt))
+            continue
+        wait = _retry_wait(attempt, response)
+        if wait is None or attempt == retries:
+            return _result(response)
+        time.sleep(wait)
+
+
+async def _asend(client, retries, **kwargs):
+    """Like `_send`, but without blocking the event loop."""
+    for attempt in range(retries + 1):
+        try:
+            response = await client.post(**kwargs)
+        except _RETRY_ERRORS:
+            if attempt == retries:
+                raise
+            await asyncio.sleep(_retry_wait(attempt))
+            continue
+        wait = _retry_wait(attempt, response)
+        if wait is None or attempt == retries:
+            return _result(response)
+        await asyncio.sleep(wait)
+
+
+def _service(service_url, token):
+    """Return the service URL and the authorization headers to use."""
     service_url = service_url or os.getenv("JUPYTERPOST_URL")
     token = token or os.getenv("JPY_API_TOKEN")
     if not service_url:
         raise ValueError("No service URL given")
     if not token:
         raise ValueError("No API token given")
-    if attachment and not isinstance(attachment, bytes):
+    return service_url, {"Authorization": f"token {token}"}
+
+
+def _as_png(attachment):
+    """Return the png of an attachment, rendering figures if needed.
+
+    Strings are assumed to be base64 encoded pngs, like the ones in IPython
+    display data, and are returned unchanged so that they are not decoded
+    and encoded again.
+    """
+    if attachment and not isinstance(attachment, (bytes, str)):
         data = BytesIO()
         try:
             attachment.savefig(data, format="png")
         except AttributeError:
             raise TypeError("attachment must be a bytes object or matplotlib figure")
         attachment = data.getvalue()
+    return attachment
 
-    response = httpx.post(
-        service_url,
-        headers={"Authorization": f"token {token}"},
-        data={"message": message, "channel": channel},
-        files={"file": attachment} if attachment else None,
+
+def _is_image(data):
+    """Whether data is a png, jpeg or webp image, which `transcode` handles."""
+    return data.startswith((b"\x89PNG\r\n\x1a\n", b"\xff\xd8\xff")) or (
+        data[:4] == b"RIFF" and data[8:12] == b"WEBP"
     )
+
+
+def _as_files(attachment, compress=None):
+    """Return ``(filename, data)`` for one attachment or a list of them.
+
+    The data is either bytes or a base64 encoded string, see `_as_png`.
+    Elements of a list may also be ``(filename, data)`` tuples already.
+    If compress is given, images are transcoded with it as arguments, keeping
+    their file name but the extension. Other files are sent unchanged.
+    """
+    if not isinstance(attachment, (list, tuple)):
+        attachment = [attachment]
+    files = []
+    for item in attachment:
+        name, data = item if isinstance(item, tuple) else ("upload.png", item)
+        data = _as_png(data)
+        if not data:
+            continue
+        if compress is not None:
+            image = b64decode(data) if isinstance(data, str) else data
+            if _is_image(image):
+                data, extension = transcode(image, **compress)
+                name = f"{os.path.splitext(name)[0]}.{extension}"
+        files.append((name, data))
+    return files
+
+
+def _request_kwargs(
+    message, channel, attachment, service_url, token, compress, coalesce
+):
+    """Validate the arguments of `post` and build the request to the service."""
+    service_url, headers = _service(service_url, token)
+    files = [
+        (
+            ("file_base64", (name, data.encode()))
+            if isinstance(data, str)
+            else ("file", (name, data))
+        )
+        for name, data in _as_files(attachment, compress)
+    ]
+    return dict(
+        url=service_url,
+        headers={**headers, "Idempotency-Key": uuid.uuid4().hex},
+        data={
+            "message": message,
+            "channel": channel,
+            **({"coalesce": "1"} if coalesce else {}),
+        },
+        files=files or None,
+    )
+
+
+def _result(response):
+    """Return the JSON response of the service, raising on errors."""
     if response.is_error:
         raise ValueError(response.text)
+    return response.json() if response.content else None
+
+
+def post(
+    message,
+    channel,
+    attachment=None,
+    service_url=None,
+    token=None,
+    compress=None,
+    coalesce=False,
+    retries=3,
+):
+    """Post a message to Mattermost using the JupyterHub service.
+
+    Parameters
+    ----------
+    message : str
+        The message to post.
+    channel : str
+        The channel to post to. If it starts with '@', it is assumed to be a
+        direct message to the user with that username.
+    attachment : bytes, str or matplotlib figure, or a list of them, optional
+        A png file to upload. If given, will be attached to the message. A
+        string is taken to be a base64 encoded png. Up to 10 files can be
+        attached by passing a list, whose elements may also be
+        ``(filename, data)`` tuples to upload files of other types.
+    service_url : str, optional
+        The URL of the JupyterHub service. If not given, will be taken from the
+        JUPYTERPOST_URL environment variable.
+    token : str, optional
+        The API token to use. If not given, will be taken from the
+        JPY_API_TOKEN environment variable.
+    compress : dict, optional
+        If given, attached images are shrunk before sending them, using these
+        keyword arguments of `jupyterpost.images.transcode`, for example
+        ``dict(max_size=1000, format="webp", quality=80)``. Requires pillow.
+    coalesce : bool, optional
+        If True, the service may merge this message with other messages you
+        send to the same channel shortly before or after, and post them
+        together after a short delay. Useful for frequent progress reports.
+    retries : int, optional
+        How often to send the post again if the service cannot be reached or
+        fails, waiting longer every time. The post is identified by a random
+        key, so that it is not posted twice. Defaults to 3.
+
+    Returns
+    -------
+    result : dict
+        ``{"post_id": id}`` with the Mattermost post id, or, if the service
+        queues posts, ``{"queue_id": id, "status": "pending"}``, see
+        `post_status`. Merged messages return ``{"status": "coalesced"}``.
+    """
+    kwargs = _request_kwargs(
+        message, channel, attachment, service_url, token, compress, coalesce
+    )
+    return _send(_get_client(kwargs["headers"]["Authorization"]), retries, **kwargs)
+
+
+async def apost(
+    message,
+    channel,
+    attachment=None,
+    service_url=None,
+    token=None,
+    compress=None,
+    coalesce=False,
+    retries=3,
+):
+    """Post a message to Mattermost without blocking the event loop.
+
+    Takes the same arguments as `post`.
+    """
+    kwargs = _request_kwargs(
+        message, channel, attachment, service_url, token, compress, coalesce
+    )
+    async with httpx.AsyncClient() as client:
+        return await _asend(client, retries, **kwargs)
+
+
+def post_in_background(
+    message,
+    channel,
+    attachment=None,
+    service_url=None,
+    token=None,
+    compress=None,
+    coalesce=False,
+    retries=3,
+):
+    """Post a message to Mattermost from a worker thread.
+
+    Takes the same arguments as `post`. The arguments are checked and
+    figures are rendered before returning, so that they may be modified
+    afterwards.
+
+    Returns
+    -------
+    future : concurrent.futures.Future
+        Resolves once the message is posted, or holds the error if posting
+        failed.
+    """
+    kwargs = _request_kwargs(
+        message, channel, attachment, service_url, token, compress, coalesce
+    )
+
+    def send():
+        client = _get_client(kwargs["headers"]["Authorization"])
+        return _send(client, retries, **kwargs)
+
+    return _executor.submit(send)
+
+
+def post_many(posts, service_url=None, token=None, compress=None, retries=3):
+    """Post several messages to Mattermost in a single request.
+
+    Parameters
+    ----------
+    posts : list of dict
+        The messages to post. Each has the keys ``message`` and ``channel``,
+        and optionally ``attachment``, with the same meaning as the arguments
+        of `post`. Messages to the same channel are posted in order. Messages
+        the service cannot post yet because of its rate limits are sent again
+        after the time it asks for.
+    service_url : str, optional
+        The URL of the JupyterHub service. If not given, will be taken from the
+        JUPYTERPOST_URL environment variable.
+    token : str, optional
+        The API token to use. If not given, will be taken from the
+        JPY_API_TOKEN environment variable.
+    compress : dict, optional
+        Shrink attached images before sending them, see `post`.
+    retries : int, optional
+        How often to send the batch again if it fails, see `post`.
+
+    Returns
+    -------
+    results : list of dict
+        For every message either ``{"post_id": post_id}`` if it was posted, or
+        ``{"error": reason}`` if it was not.
+    """
+    service_url, headers = _service(service_url, token)
+    batch = []
+    for item in posts:
+        attachments = [
+            {
+                "filename": name,
+                "data": data if isinstance(data, str) else b64encode(data).decode(),
+            }
+            for name, data in _as_files(item.get("attachment"), compress)
+        ]
+        batch.append(
+            {
+                "message": item["message"],
+                "channel": item["channel"],
+                "attachments": attachments,
+            }
+        )
+    results = [None] * len(batch)
+    pending = list(range(len(batch)))
+    while pending:
+        response = _send(
+            _get_client(headers["Authorization"]),
+            retries,
+            url=service_url.rstrip("/") + "/batch",
+            headers={**headers, "Idempotency-Key": uuid.uuid4().hex},
+            json=[batch[i] for i in pending],
+        )
+        limited = [i for i, result in zip(pending, response) if "retry_after" in result]
+        wait = max((result.get("retry_after", 0) for result in response), default=0)
+        for i, result in zip(pending, response):
+            results[i] = result
+        pending = limited
+        if pending:
+            time.sleep(wait)
+    return results
+
+
+def post_status(queue_id, service_url=None, token=None):
+    """Return the status of a post queued by the service.
+
+    The service queues posts instead of sending them right away if it is
+    configured with a ``queue_path``. `post` then returns a ``queue_id``.
+
+    Parameters
+    ----------
+    queue_id : int
+        The queue id returned by `post`.
+    service_url : str, optional
+        The URL of the JupyterHub service. If not given, will be taken from the
+        JUPYTERPOST_URL environment variable.
+    token : str, optional
+        The API token to use. If not given, will be taken from the
+        JPY_API_TOKEN environment variable.
+
+    Returns
+    -------
+    status : dict
+        With the keys ``status`` (one of "pending", "sending", "sent" or
+        "failed"), ``attempts``, ``error`` and ``post_id``.
+    """
+    service_url, headers = _service(service_url, token)
+    response = _get_client(headers["Authorization"]).get(
+        service_url.rstrip("/") + f"/status/{queue_id}", headers=headers
+    )
+    return _result(response)
 
 
 @magics_class
@@ -85,6 +456,24 @@ class JupyterpostMagics(Magics):
             "Does not execute the cell."
         ),
     )
+    @magic_arguments.argument(
+        "-b",
+        "--background",
+        action="store_true",
+        help=(
+            "Post without waiting for the message to be delivered. "
+            "Failures are reported below the cell."
+        ),
+    )
+    @magic_arguments.argument(
+        "-c",
+        "--coalesce",
+        action="store_true",
+        help=(
+            "Allow merging with other messages to the same channel sent "
+            "within a few seconds, for example progress reports in a loop."
+        ),
+    )
     @magic_arguments.argument(
         "--url",
         type=str,
@@ -106,12 +495,12 @@ class JupyterpostMagics(Magics):
         if cell is None:
             if not message:
                 raise ValueError("No message given")
-            post(message, args.channel, service_url=args.url, token=args.token)
+            self._post(args, message)
             return
         message = [message] if message else ["​"] # Zero-width space for linebreaks
         if args.raw:
             message = "\n".join((message[0], cell))
-            post(message, args.channel, service_url=args.url, token=args.token)
+            self._post(args, message)
             return
 
         if args.input:
@@ -127,16 +516,21 @@ class JupyterpostMagics(Magics):
         for output in captured.outputs:
             for mime_type in [
                 "image/png",
-                # TODO: support other images
-                # "image/jpeg", "image/svg+xml",
+                "image/jpeg",
+                "image/svg+xml",
                 "text/markdown",
                 "text/latex",
                 "text/plain",
             ]:
                 if mime_type not in output.data:
                     continue
-                if mime_type.startswith("image"):
-                    attachments.append(output.data[mime_type])
+                if mime_type == "image/svg+xml":
+                    attachments.append(_svg_attachment(output.data[mime_type]))
+                    break
+                elif mime_type.startswith("image"):
+                    # Sent base64 encoded as is, the service decodes it
+                    extension = "png" if mime_type == "image/png" else "jpg"
+                    attachments.append((f"upload.{extension}", output.data[mime_type]))
                     break
                 elif mime_type == "text/plain":
                     # Treat as preformatted text
@@ -148,14 +542,46 @@ class JupyterpostMagics(Magics):
         message = "\n".join(message)
         if not message and not attachments:
             raise ValueError("No message or attachments given")
-        # TODO: support multiple attachments
-        post(
-            message,
-            args.channel,
-            b64decode(attachments[0]) if attachments else None,
-            service_url=args.url,
-            token=args.token,
-        )
+        self._post(args, message, attachments)
+
+    def _post(self, args, message, attachments=()):
+        """Post using the service settings of the parsed magic arguments.
+
+        If there are more than `MAX_ATTACHMENTS` attachments, the rest are
+        sent in further posts following the message.
+        """
+        kwargs = dict(service_url=args.url, token=args.token, coalesce=args.coalesce)
+        posts = [
+            ("​" if i else message, attachments[i : i + MAX_ATTACHMENTS])
+            for i in range(0, max(len(attachments), 1), MAX_ATTACHMENTS)
+        ]
+        if not args.background:
+            for text, files in posts:
+                post(text, args.channel, files, **kwargs)
+            return
+        # The posts are sent one after another by the single worker thread
+        futures = [
+            post_in_background(text, args.channel, files, **kwargs)
+            for text, files in posts
+        ]
+        handle = display(f"Posting to {args.channel}...", display_id=True)
+
+        def report(_):
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if not errors:
+                handle.update(f"Posted to {args.channel}")
+            else:
+                handle.update(f"Posting to {args.channel} failed: {errors[0]}")
+
+        futures[-1].add_done_callback(report)
+
+
+def _svg_attachment(svg):
+    """Rasterize an svg output, or attach it as is if cairosvg is missing."""
+    try:
+        return "upload.png", rasterize_svg(svg)
+    except ImportError:
+        return "upload.svg", svg.encode() if isinstance(svg, str) else svg
 
 
 def load_ipython_extension(ipython):
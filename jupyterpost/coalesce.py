@@ -0,0 +1,67 @@
+"""Merging of messages that are posted in quick succession."""
+import asyncio
+import logging
+
+logger = logging.getLogger("jupyterpost")
+
+
+class Coalescer:
+    """Collect messages with the same key and send them together.
+
+    The first message with a key starts a window. Messages with the same key
+    arriving within the window are sent as one post when it ends.
+
+    Parameters
+    ----------
+    window : float
+        The length of the window in seconds.
+    send : coroutine function
+        Called as ``send(key, messages, files)`` with the list of collected
+        messages and the list of their attachments.
+    max_files : int, optional
+        The most attachments to collect. A message that would exceed this
+        ends the window early.
+    """
+
+    def __init__(self, window, send, max_files=10):
+        self.window = window
+        self.send = send
+        self.max_files = max_files
+        self._pending = {}
+        self._tasks = set()
+
+    def add(self, key, message, files=()):
+        """Add a message to be sent at the end of the window of its key."""
+        files = list(files)
+        pending = self._pending.get(key)
+        if pending is not None and len(pending["files"]) + len(files) > self.max_files:
+            pending["timer"].cancel()
+            self._flush(key)
+            pending = None
+        if pending is None:
+            timer = asyncio.get_running_loop().call_later(
+                self.window, self._flush, key
+            )
+            pending = self._pending[key] = {"messages": [], "files": [], "timer": timer}
+        pending["messages"].append(message)
+        pending["files"].extend(files)
+
+    def _flush(self, key):
+        pending = self._pending.pop(key)
+        task = asyncio.ensure_future(self._send(key, pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _send(self, key, pending):
+        try:
+            await self.send(key, pending["messages"], pending["files"])
+        except Exception:
+            count = len(pending["messages"])
+            logger.exception("Posting %d merged messages failed", count)
+
+    async def flush_all(self):
+        """Send all collected messages now and wait until they are sent."""
+        for key, pending in list(self._pending.items()):
+            pending["timer"].cancel()
+            self._flush(key)
+        await asyncio.gather(*self._tasks)
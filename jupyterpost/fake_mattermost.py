@@ -0,0 +1,261 @@
+"""A fake Mattermost API for load testing the service.
+
+Implements the calls the service makes: users/me, users/username, teams,
+team channels and members, channels/direct, files and posts. Every user,
+team and channel exists unless it is listed as missing. Responses can be
+delayed and made to fail at random, and the next posts can be made to fail
+in a given way. Posts are counted and discarded, unless they are recorded
+for tests. Like Mattermost, a post with the pending_post_id of one made in
+the last 30 seconds is not created again.
+
+Run it with ``python -m jupyterpost.fake_mattermost`` and point
+MATTERMOST_URL of the service to ``http://127.0.0.1:8065/api/v4/``.
+"""
+import argparse
+import asyncio
+from collections import Counter
+import hashlib
+import json
+import logging
+import random
+
+from tornado.ioloop import IOLoop
+from tornado.web import Application, RequestHandler, stream_request_body
+
+from .cache import MISSING, TTLCache
+
+logger = logging.getLogger("jupyterpost")
+
+
+def _id(kind, *names):
+    """Return a stable fake Mattermost id for an object."""
+    return kind + "-" + hashlib.sha1("/".join(names).encode()).hexdigest()[:20]
+
+
+class FakeHandler(RequestHandler):
+    """Base of the fake API handlers, applying latency and errors.
+
+    The latency and errors are taken from the application settings, so they
+    can be changed while the application runs.
+    """
+
+    async def inject(self):
+        """Wait for the latency and return whether the request should fail."""
+        self.settings["stats"]["requests"] += 1
+        delay = self.settings["latency"] + random.uniform(0, self.settings["jitter"])
+        if delay:
+            await asyncio.sleep(delay)
+        return random.random() < self.settings["error_rate"]
+
+    async def prepare(self):
+        if await self.inject():
+            self.fail()
+
+    def fail(self):
+        """Answer with the injected error."""
+        status = self.settings["error_status"]
+        self.settings["stats"][f"errors {status}"] += 1
+        self.set_status(status)
+        if status == 429:
+            self.set_header("Retry-After", "1")
+        self.finish({"message": "Injected error"})
+
+    def reply(self, status, body):
+        self.set_status(status)
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(body))
+
+    def json(self):
+        return json.loads(self.request.body)
+
+    def exists(self, name):
+        """Whether a user or channel exists, answering 404 if not."""
+        if name in self.settings["missing"]:
+            self.set_status(404)
+            self.finish({"message": f"{name} not found"})
+            return False
+        return True
+
+
+class MeHandler(FakeHandler):
+    def get(self):
+        self.reply(200, {"id": _id("user", "bot"), "username": "bot"})
+
+
+class UserHandler(FakeHandler):
+    def get(self, username):
+        if self.exists(username):
+            self.reply(200, {"id": _id("user", username), "username": username})
+
+
+class TeamHandler(FakeHandler):
+    def get(self, team):
+        self.reply(200, {"id": _id("team", team), "name": team})
+
+
+class TeamMemberHandler(FakeHandler):
+    def get(self, team_id, user_id):
+        self.reply(200, {"team_id": team_id, "user_id": user_id})
+
+
+class ChannelHandler(FakeHandler):
+    def get(self, team, channel):
+        if self.exists(channel):
+            self.reply(200, {"id": _id("channel", team, channel), "name": channel})
+
+
+class ChannelMemberHandler(FakeHandler):
+    def post(self, channel_id):
+        self.reply(201, {"channel_id": channel_id, "user_id": self.json()["user_id"]})
+
+
+class DirectChannelHandler(FakeHandler):
+    def post(self):
+        self.reply(201, {"id": _id("direct", *sorted(self.json()))})
+
+
+@stream_request_body
+class FileHandler(FakeHandler):
+    """Accept uploads of any size, keeping them only if files are recorded."""
+
+    async def prepare(self):
+        self.request.connection.set_max_body_size(2**40)
+        self.size = 0
+        self.data = bytearray() if self.settings["files"] is not None else None
+        # Fail only once the upload is read, like Mattermost does
+        self.failing = await self.inject()
+
+    def data_received(self, chunk):
+        self.size += len(chunk)
+        if self.data is not None:
+            self.data += chunk
+
+    def post(self):
+        if self.failing:
+            self.fail()
+            return
+        stats = self.settings["stats"]
+        stats["files"] += 1
+        stats["file bytes"] += self.size
+        file_id = _id("file", str(stats["files"]))
+        if self.data is not None:
+            filename = self.get_argument("filename")
+            self.settings["files"].append((filename, bytes(self.data)))
+        self.reply(201, {"file_infos": [{"id": file_id, "size": self.size}]})
+
+
+class PostHandler(FakeHandler):
+    """Create posts, or fail as told by the ``post_faults`` setting.
+
+    Every element of ``post_faults`` is used up by one post. A status code is
+    answered without creating the post, "drop" closes the connection without
+    creating it, and "lose" creates it and then closes the connection, as if
+    the answer was lost.
+    """
+
+    def post(self):
+        post = self.json()
+        pending = self.settings["pending_posts"]
+        created = pending.get(post.get("pending_post_id"))
+        if created is not MISSING:
+            self.settings["stats"]["repeated posts"] += 1
+            self.reply(201, created)
+            return
+        faults = self.settings["post_faults"]
+        fault = faults.pop(0) if faults else None
+        if fault == "drop":
+            self.request.connection.close()
+            return
+        if fault not in (None, "lose"):
+            self.set_status(fault)
+            self.finish({"message": "Injected error"})
+            return
+        stats = self.settings["stats"]
+        stats["posts"] += 1
+        created = {"id": _id("post", str(stats["posts"])), **post}
+        if post.get("pending_post_id"):
+            pending.set(post["pending_post_id"], created)
+        if self.settings["posts"] is not None:
+            self.settings["posts"].append(created)
+        if fault == "lose":
+            self.request.connection.close()
+            return
+        self.reply(201, created)
+
+
+def make_app(latency=0, jitter=0, error_rate=0, error_status=503, record=False):
+    """Create the fake Mattermost application.
+
+    Parameters
+    ----------
+    latency : float, optional
+        Seconds to wait before answering every request.
+    jitter : float, optional
+        Up to this many seconds are added to the latency at random.
+    error_rate : float, optional
+        The fraction of requests that fail.
+    error_status : int, optional
+        The status code of failed requests. Defaults to 503. 429 responses
+        ask to retry after a second.
+    record : bool, optional
+        Keep the created posts in ``app.settings["posts"]`` and the uploaded
+        files as ``(filename, data)`` in ``app.settings["files"]``.
+
+    Returns
+    -------
+    app : tornado.web.Application
+        The application. ``app.settings["stats"]`` counts requests, errors,
+        files, posts and repeated posts. The arguments are kept in the
+        settings of the same name. Add names of users and channels that do
+        not exist to ``app.settings["missing"]``, and faults of the next
+        posts to ``app.settings["post_faults"]``, see `PostHandler`.
+    """
+    api = "/api/v4/"
+    return Application(
+        [
+            (api + "users/me", MeHandler),
+            (api + "users/username/([^/]+)", UserHandler),
+            (api + "teams/name/([^/]+)", TeamHandler),
+            (api + "teams/name/([^/]+)/channels/name/([^/]+)", ChannelHandler),
+            (api + "teams/([^/]+)/members/([^/]+)", TeamMemberHandler),
+            (api + "channels/direct", DirectChannelHandler),
+            (api + "channels/([^/]+)/members", ChannelMemberHandler),
+            (api + "files", FileHandler),
+            (api + "posts", PostHandler),
+        ],
+        latency=latency,
+        jitter=jitter,
+        error_rate=error_rate,
+        error_status=error_status,
+        stats=Counter(),
+        pending_posts=TTLCache(maxsize=100000, ttl=30),
+        missing=set(),
+        post_faults=[],
+        posts=[] if record else None,
+        files=[] if record else None,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a fake Mattermost API.")
+    parser.add_argument("--port", type=int, default=8065)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--latency", type=float, default=0, help="seconds")
+    parser.add_argument("--jitter", type=float, default=0, help="seconds")
+    parser.add_argument("--error-rate", type=float, default=0)
+    parser.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+    app = make_app(args.latency, args.jitter, args.error_rate, args.error_status)
+    app.listen(args.port, args.host)
+    logging.basicConfig(level=logging.INFO)
+    logger.info("Fake Mattermost at http://%s:%s/api/v4/", args.host, args.port)
+    try:
+        IOLoop.current().start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info("Served %s", dict(app.settings["stats"]))
+
+
+if __name__ == "__main__":
+    main()
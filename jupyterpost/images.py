@@ -0,0 +1,126 @@
+"""Preparing images before they are uploaded to Mattermost.
+
+Transcoding requires pillow and rasterizing svg images requires cairosvg, both
+are optional dependencies of jupyterpost.
+"""
+from collections import OrderedDict
+import hashlib
+from io import BytesIO
+import os
+
+FORMATS = {"png": "png", "jpeg": "jpg", "jpg": "jpg", "webp": "webp"}
+
+
+def transcode(data, max_size=None, format="png", quality=None):
+    """Downscale and recompress an image.
+
+    Parameters
+    ----------
+    data : bytes
+        The image to transcode, in any format pillow can read.
+    max_size : int or tuple of int, optional
+        The largest allowed width and height in pixels. Larger images are
+        scaled down keeping their aspect ratio.
+    format : str, optional
+        The format to save in, one of "png", "jpeg" or "webp". Defaults to
+        "png", which is saved with the strongest compression.
+    quality : int, optional
+        The quality from 1 to 100 for the lossy formats "jpeg" and "webp".
+
+    Returns
+    -------
+    data : bytes
+        The transcoded image.
+    extension : str
+        The file extension matching the format.
+    """
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ImportError("Transcoding images requires pillow") from None
+    format = format.lower()
+    if format not in FORMATS:
+        raise ValueError(f"Unsupported image format {format}")
+    format = "jpeg" if format == "jpg" else format
+    image = Image.open(BytesIO(data))
+    original_size = image.size
+    if max_size:
+        if isinstance(max_size, int):
+            max_size = (max_size, max_size)
+        image.thumbnail(max_size)
+    if format == "jpeg" and image.mode not in ("RGB", "L"):
+        # No transparency in jpeg, put the image on a white background
+        background = Image.new("RGB", image.size, "white")
+        image = image.convert("RGBA")
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    options = {"optimize": True} if format == "png" else {}
+    if quality is not None and format != "png":
+        options["quality"] = quality
+    result = BytesIO()
+    image.save(result, format=format.upper(), **options)
+    result = result.getvalue()
+    if (
+        format == "png"
+        and image.size == original_size
+        and len(result) >= len(data)
+        and data.startswith(b"\x89PNG")
+    ):
+        # Recompressing did not help
+        return data, "png"
+    return result, FORMATS[format]
+
+
+def options_from_env():
+    """Return the `transcode` arguments configured for the service, or None.
+
+    These are set by `jupyterpost.configure_jupyterhub` through the
+    JUPYTERPOST_IMAGE_FORMAT, JUPYTERPOST_IMAGE_MAX_SIZE and
+    JUPYTERPOST_IMAGE_QUALITY environment variables.
+    """
+    options = {}
+    if os.getenv("JUPYTERPOST_IMAGE_FORMAT"):
+        options["format"] = os.environ["JUPYTERPOST_IMAGE_FORMAT"]
+    if os.getenv("JUPYTERPOST_IMAGE_MAX_SIZE"):
+        options["max_size"] = int(os.environ["JUPYTERPOST_IMAGE_MAX_SIZE"])
+    if os.getenv("JUPYTERPOST_IMAGE_QUALITY"):
+        options["quality"] = int(os.environ["JUPYTERPOST_IMAGE_QUALITY"])
+    return options or None
+
+
+# Rasterized svg images by the sha256 of their source, see `rasterize_svg`.
+_svg_cache = OrderedDict()
+SVG_CACHE_SIZE = 32
+
+
+def rasterize_svg(svg):
+    """Render an svg image to png.
+
+    The result is cached by the hash of the svg source, so that posting the
+    same output again does not render it again. Requires cairosvg.
+
+    Parameters
+    ----------
+    svg : str or bytes
+        The svg source.
+
+    Returns
+    -------
+    png : bytes
+        The rendered image.
+    """
+    if isinstance(svg, str):
+        svg = svg.encode()
+    digest = hashlib.sha256(svg).digest()
+    if digest in _svg_cache:
+        _svg_cache.move_to_end(digest)
+        return _svg_cache[digest]
+    try:
+        import cairosvg
+    except ImportError:
+        raise ImportError("Rasterizing svg images requires cairosvg") from None
+    png = cairosvg.svg2png(bytestring=svg)
+    _svg_cache[digest] = png
+    while len(_svg_cache) > SVG_CACHE_SIZE:
+        _svg_cache.popitem(last=False)
+    return png
@@ -3,28 +3,157 @@
 Modeled after the JupyterHub Service example at
 https://github.com/jupyterhub/jupyterhub/tree/main/examples/service-whoami
 """
+import asyncio
+import binascii
+import hashlib
+import json
+import math
 import os
+import tempfile
+import time
 from urllib.parse import urlparse
 import logging
-from io import BytesIO
+from base64 import b64decode
+from functools import partial
 
 from tornado.httpserver import HTTPServer
-from tornado.ioloop import IOLoop
-from tornado.web import Application, RequestHandler, authenticated
+from tornado.ioloop import IOLoop, PeriodicCallback
+from tornado.netutil import bind_sockets
+from tornado.process import cpu_count, fork_processes
+from tornado.httputil import parse_body_arguments
+from tornado.web import (
+    Application,
+    HTTPError,
+    RequestHandler,
+    authenticated,
+    stream_request_body,
+)
 import httpx
 
+# With several processes the metrics are kept in files in this directory, see
+# `jupyterpost.metrics`. prometheus_client, also used by JupyterHub, creates
+# them as soon as metrics are defined, so it must exist before the imports.
+if os.getenv("PROMETHEUS_MULTIPROC_DIR"):
+    os.makedirs(os.environ["PROMETHEUS_MULTIPROC_DIR"], exist_ok=True)
+
 from jupyterhub.services.auth import HubAuthenticated
 from jupyterhub.roles import get_default_roles
 from jupyterhub.app import JupyterHub
 
-from IPython.core import magic_arguments
-from IPython.core.magic import register_cell_magic
-from IPython.display import display
-from IPython.utils.capture import capture_output
+from .cache import TTLCache, MISSING
+from .images import FORMATS, transcode, options_from_env as image_options
+from .coalesce import Coalescer
+from . import metrics, tracing
+from .multipart import Base64Decoder, MultipartParser, get_boundary
+from .outbox import Outbox
+from .ratelimit import RateLimited, SlidingWindow, TokenBucket, retry_after
 
 logger = logging.getLogger("jupyterpost")
 logger.setLevel(logging.INFO)
 
+# Shared connection pool to Mattermost, see `open_mm_client`.
+_mm_client = None
+# User id of the bot, see `get_bot_id`.
+_bot_id = None
+# Team ids by team name, see `get_team_id`.
+_team_ids = {}
+# Ids of team channels the bot has joined, see `resolve_channel`.
+_channel_cache = TTLCache(
+    maxsize=int(os.getenv("MATTERMOST_CHANNEL_CACHE_SIZE", 1024)),
+    ttl=float(os.getenv("MATTERMOST_CHANNEL_CACHE_TTL", 600)),
+)
+# Mattermost refuses posts with more files than this.
+MAX_ATTACHMENTS = 10
+_negative_cache_ttl = float(os.getenv("MATTERMOST_NEGATIVE_CACHE_TTL", 60))
+# User ids and team membership, see `resolve_direct_channel`.
+_user_cache = TTLCache(
+    maxsize=int(os.getenv("MATTERMOST_USER_CACHE_SIZE", 4096)),
+    ttl=float(os.getenv("MATTERMOST_USER_CACHE_TTL", 3600)),
+)
+_member_cache = TTLCache(
+    maxsize=int(os.getenv("MATTERMOST_USER_CACHE_SIZE", 4096)),
+    ttl=float(os.getenv("MATTERMOST_USER_CACHE_TTL", 3600)),
+)
+# Direct channels between the bot and users, keyed by (bot id, username, team).
+_direct_channel_cache = TTLCache(
+    maxsize=int(os.getenv("MATTERMOST_USER_CACHE_SIZE", 4096)),
+    ttl=float(os.getenv("MATTERMOST_DIRECT_CHANNEL_CACHE_TTL", 3600)),
+)
+# Pacing of all calls to Mattermost, and of posts to each channel.
+_rate_limit = TokenBucket(
+    rate=float(os.getenv("MATTERMOST_RATE_LIMIT", 10)),
+    burst=int(os.getenv("MATTERMOST_RATE_BURST", 100)),
+)
+_channel_rate_limits = TTLCache(maxsize=1024, ttl=600)
+_channel_rate = float(os.getenv("MATTERMOST_CHANNEL_RATE_LIMIT", 1))
+_channel_burst = int(os.getenv("MATTERMOST_CHANNEL_RATE_BURST", 5))
+# Longest wait for the channel rate limit while a client waits for the answer
+_channel_max_wait = float(os.getenv("MATTERMOST_CHANNEL_MAX_WAIT", 2))
+_max_retries = int(os.getenv("MATTERMOST_MAX_RETRIES", 3))
+# Results of requests by username and idempotency key, see `IdempotentRequest`.
+_idempotency_cache = TTLCache(
+    maxsize=int(os.getenv("JUPYTERPOST_IDEMPOTENCY_CACHE_SIZE", 10000)),
+    ttl=float(os.getenv("JUPYTERPOST_IDEMPOTENCY_TTL", 3600)),
+)
+# Limits on posts per hub user, see `check_quota`.
+_user_post_limit = SlidingWindow(
+    float(os.getenv("JUPYTERPOST_USER_POSTS_PER_MINUTE") or "inf"), 60
+)
+_user_byte_limit = SlidingWindow(
+    float(os.getenv("JUPYTERPOST_USER_BYTES_PER_HOUR") or "inf"), 3600
+)
+
+
+def open_mm_client(max_connections=None, keepalive_expiry=None, http2=None):
+    """Create the service-wide client used for Mattermost API calls.
+
+    Parameters
+    ----------
+    max_connections : int, optional
+        The maximum number of simultaneous connections to Mattermost. If not
+        given, will be taken from the MATTERMOST_MAX_CONNECTIONS environment
+        variable, defaulting to 20.
+    keepalive_expiry : float, optional
+        Seconds after which idle connections are closed. If not given, will be
+        taken from the MATTERMOST_KEEPALIVE_EXPIRY environment variable,
+        defaulting to 60.
+    http2 : bool, optional
+        Whether to use HTTP/2 (requires ``httpx[http2]``). If not given, will
+        be taken from the MATTERMOST_HTTP2 environment variable.
+
+    Returns
+    -------
+    client : httpx.AsyncClient
+        The shared client. Calling this again returns the existing client.
+    """
+    global _mm_client
+    if _mm_client is not None and not _mm_client.is_closed:
+        return _mm_client
+    if max_connections is None:
+        max_connections = int(os.getenv("MATTERMOST_MAX_CONNECTIONS", 20))
+    if keepalive_expiry is None:
+        keepalive_expiry = float(os.getenv("MATTERMOST_KEEPALIVE_EXPIRY", 60))
+    if http2 is None:
+        http2 = os.getenv("MATTERMOST_HTTP2", "").lower() in ("1", "true", "yes")
+    _mm_client = httpx.AsyncClient(
+        headers={"Authorization": f"Bearer {os.environ['MATTERMOST_TOKEN']}"},
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=keepalive_expiry,
+        ),
+        http2=http2,
+    )
+    return _mm_client
+
+
+async def close_mm_client():
+    """Close the shared Mattermost client, if it is open."""
+    global _mm_client
+    if _mm_client is not None:
+        await _mm_client.aclose()
+        _mm_client = None
+
 
 async def mm_api_call(method, path, **kwargs):
     """Make an API call to Mattermost.
@@ -37,109 +166,1093 @@ async def mm_api_call(method, path, **kwargs):
         The API URL to call. The base URL will be taken from the
         MATTERMOST_URL environment variable.
     **kwargs : dict
-        Additional keyword arguments to pass to httpx.request.
+        Additional keyword arguments to pass to httpx.AsyncClient.request.
+
+    Calls are paced to stay within the Mattermost rate limits, and calls that
+    are rate limited nevertheless are retried after the time Mattermost asks
+    for, up to MATTERMOST_MAX_RETRIES times.
 
     Returns
     -------
     response
         The JSON response from the API call.
     """
+    global _bot_id
     url = os.environ["MATTERMOST_URL"] + path
-    token = os.environ["MATTERMOST_TOKEN"]
-    headers = {"Authorization": f"Bearer {token}"}
-    async with httpx.AsyncClient() as client:
-        response = await client.request(method, url, headers=headers, **kwargs)
+    # A streamed body can only be sent once
+    content = kwargs.get("content")
+    retries = _max_retries if content is None or isinstance(content, bytes) else 0
+    endpoint = metrics.endpoint(path)
+    with tracing.span(
+        f"Mattermost {method.upper()} {endpoint}",
+        **{"http.request.method": method.upper(), "jupyterpost.endpoint": endpoint},
+    ) as span:
+        waited = 0
+        for attempt in range(retries + 1):
+            start = time.perf_counter()
+            await _rate_limit.acquire()
+            waited += time.perf_counter() - start
+            start = time.perf_counter()
+            try:
+                response = await open_mm_client().request(method, url, **kwargs)
+            except httpx.TransportError:
+                metrics.observe_mattermost(
+                    method, path, "error", time.perf_counter() - start
+                )
+                raise
+            metrics.observe_mattermost(
+                method, path, response.status_code, time.perf_counter() - start
+            )
+            _rate_limit.update(response.headers)
+            if response.status_code != 429 or attempt == retries:
+                break
+            delay = retry_after(response)
+            logger.info("Rate limited by Mattermost, retrying in %.1f s", delay)
+            _rate_limit.pause(delay)
+        if span is not None:
+            span.set_attributes(
+                {
+                    "http.response.status_code": response.status_code,
+                    "jupyterpost.attempts": attempt + 1,
+                    "jupyterpost.rate_limit_wait": waited,
+                }
+            )
+        if response.status_code == 401:
+            # The token was revoked or replaced, forget who we are.
+            _bot_id = None
         response.raise_for_status()
     return response.json()
 
 
-async def hub_post_message(message, channel, file_=None, team_name=None):
-    """Post a message to Mattermost from the JupyterHub service.
+async def get_bot_id():
+    """Return the Mattermost user id of the bot.
+
+    The id is fetched once and reused until Mattermost rejects the token.
+    """
+    global _bot_id
+    if _bot_id is None:
+        _bot_id = (await mm_api_call("get", "users/me"))["id"]
+    return _bot_id
+
+
+async def get_team_id(team_name):
+    """Return the id of a Mattermost team.
+
+    Team ids are fetched once and kept until `invalidate_team_id` is called.
+    """
+    if team_name not in _team_ids:
+        team = await mm_api_call("get", f"teams/name/{team_name}")
+        _team_ids[team_name] = team["id"]
+    return _team_ids[team_name]
+
+
+def invalidate_team_id(team_name=None):
+    """Forget the id of a team, or of all teams if no name is given."""
+    if team_name is None:
+        _team_ids.clear()
+    else:
+        _team_ids.pop(team_name, None)
+
+
+async def connect_mattermost(team_name=None):
+    """Check the Mattermost token and resolve the team id.
 
     Parameters
     ----------
-    message : str
-        The message to post.
-    channel : str
-        The channel to post to. If it starts with '@', it is assumed to be a
-        direct message to the user with that username.
-    file_ : bytes, optional
-        A file to upload. If given, will be attached to the message.
     team_name : str, optional
         The name of the team to post to. If not given, will be taken from the
         MATTERMOST_TEAM environment variable.
+
+    Raises
+    ------
+    RuntimeError
+        If the token is rejected or the team does not exist.
     """
     team_name = team_name or os.getenv("MATTERMOST_TEAM")
-    me = (await mm_api_call("get", "users/me"))["id"]
-    if channel.startswith("@"):
-        # A direct message
-        try:
-            other = (await mm_api_call("get", f"users/username/{channel[1:]}"))["id"]
-        except httpx.HTTPStatusError as e:
-            if e.response.status_code == 404:
-                # User does not exist
-                raise ValueError(f"{channel} does not exist")
-            else:
-                raise
-        # Check if they are a member of the team
-        team_id = (await mm_api_call("get", f"teams/name/{team_name}"))["id"]
+    try:
+        await get_bot_id()
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 401:
+            raise RuntimeError("Mattermost rejected MATTERMOST_TOKEN") from e
+        raise
+    try:
+        await get_team_id(team_name)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code in (403, 404):
+            raise RuntimeError(
+                f"Mattermost team {team_name} does not exist or the bot is not in it"
+            ) from e
+        raise
+
+
+async def resolve_channel(channel, team_name, me):
+    """Return the id of a team channel, joining it if needed.
+
+    The result is cached, so that repeated posts to the same channel do not
+    look it up and join it again. Channels that do not exist are cached for a
+    shorter time.
+    """
+    key = (team_name, channel)
+    channel_id = _channel_cache.get(key)
+    if channel_id is None:
+        # Known not to exist
+        raise ValueError(f"{channel} does not exist or is private")
+    if channel_id is not MISSING:
+        return channel_id
+    try:
+        channel_id = (
+            await mm_api_call("get", f"teams/name/{team_name}/channels/name/{channel}")
+        )["id"]
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            # Channel does not exist or is private
+            _channel_cache.set(key, None, ttl=_negative_cache_ttl)
+            raise ValueError(f"{channel} does not exist or is private")
+        else:
+            raise
+    # Join the channel (this is idempotent)
+    await mm_api_call("post", f"channels/{channel_id}/members", json={"user_id": me})
+    _channel_cache.set(key, channel_id)
+    return channel_id
+
+
+async def gather(*aws):
+    """Run awaitables concurrently and return their results.
+
+    Unlike `asyncio.gather`, all awaitables are finished before an error is
+    raised, and the error of the first failing awaitable in argument order is
+    raised, so that error reporting does not depend on timing.
+    """
+    results = await asyncio.gather(*aws, return_exceptions=True)
+    for result in results:
+        if isinstance(result, BaseException):
+            raise result
+    return results
+
+
+async def fetch_user(channel):
+    """Look up and cache the user id for a direct message target '@username'."""
+    try:
+        other = (await mm_api_call("get", f"users/username/{channel[1:]}"))["id"]
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code == 404:
+            # User does not exist
+            _user_cache.set(channel[1:], None, ttl=_negative_cache_ttl)
+            raise ValueError(f"{channel} does not exist")
+        else:
+            raise
+    _user_cache.set(channel[1:], other)
+    return other
+
+
+async def resolve_direct_channel(channel, team_name, me):
+    """Return the id of the direct channel between the bot and a user.
+
+    The user must be a member of the team. User ids, team membership and
+    direct channel ids are cached separately, so that a repeated message to
+    the same user needs no lookups.
+    """
+    key = (me, channel[1:], team_name)
+    channel_id = _direct_channel_cache.get(key)
+    if channel_id is not MISSING:
+        return channel_id
+    other = _user_cache.get(channel[1:])
+    if other is None:
+        raise ValueError(f"{channel} does not exist")
+    if other is MISSING:
+        # The team id is normally known already, but if it is not, look it up
+        # at the same time as the user.
+        other, _ = await gather(fetch_user(channel), get_team_id(team_name))
+    # Check if they are a member of the team
+    is_member = _member_cache.get((team_name, other))
+    if is_member is MISSING:
+        team_id = await get_team_id(team_name)
         try:
             await mm_api_call("get", f"teams/{team_id}/members/{other}")
         except httpx.HTTPStatusError as e:
             if e.response.status_code == 404:
-                # Not a member, refuse to post
-                raise ValueError(f"{channel} is not a member of {team_name}")
+                is_member = False
+                _member_cache.set((team_name, other), False, ttl=_negative_cache_ttl)
             else:
                 raise
-        channel = await mm_api_call("post", "channels/direct", json=[me, other])
+        else:
+            is_member = True
+            _member_cache.set((team_name, other), True)
+    if not is_member:
+        # Not a member, refuse to post
+        raise ValueError(f"{channel} is not a member of {team_name}")
+    channel_id = (await mm_api_call("post", "channels/direct", json=[me, other]))["id"]
+    _direct_channel_cache.set(key, channel_id)
+    return channel_id
+
+
+def cache_stats():
+    """Return the hit and miss counts of the service caches.
+
+    Returns
+    -------
+    stats : dict
+        Maps the cache name to a dict with ``hits``, ``misses`` and ``size``.
+    """
+    caches = {
+        "channel": _channel_cache,
+        "user": _user_cache,
+        "member": _member_cache,
+        "direct_channel": _direct_channel_cache,
+    }
+    return {
+        name: {"hits": cache.hits, "misses": cache.misses, "size": len(cache)}
+        for name, cache in caches.items()
+    }
+
+
+async def resolve_channel_id(channel, team_name=None):
+    """Return the id of a channel, see `hub_post_message` for the arguments."""
+    team_name = team_name or os.getenv("MATTERMOST_TEAM")
+    me = await get_bot_id()
+    if channel.startswith("@"):
+        return await resolve_direct_channel(channel, team_name, me)
+    return await resolve_channel(channel, team_name, me)
+
+
+async def _measured(chunks):
+    """Pass on streamed chunks, recording their total size at the end."""
+    size = 0
+    async for chunk in chunks:
+        size += len(chunk)
+        yield chunk
+    metrics.UPLOAD_SIZE.observe(size)
+
+
+async def upload_file(channel_id, content, filename="upload.png"):
+    """Upload a file to a channel and return its id.
+
+    Parameters
+    ----------
+    channel_id : str
+        The id of the channel the file will be posted to.
+    content : bytes or async iterable of bytes
+        The file contents. An iterable is streamed to Mattermost as it is
+        produced.
+    filename : str, optional
+        The name of the file. Defaults to "upload.png".
+    """
+    if isinstance(content, bytes):
+        metrics.UPLOAD_SIZE.observe(len(content))
     else:
+        content = _measured(content)
+    upload = await mm_api_call(
+        "post",
+        "files",
+        params={"channel_id": channel_id, "filename": filename},
+        content=content,
+    )
+    return upload["file_infos"][0]["id"]
+
+
+async def _transcode_and_upload(channel_id, filename, data):
+    """Upload a file, shrinking it first if it is an image and configured so."""
+    options = image_options()
+    if options is not None and filename.endswith(".png"):
         try:
-            channel = await mm_api_call(
-                "get", f"teams/name/{team_name}/channels/name/{channel}"
+            data, extension = await asyncio.get_running_loop().run_in_executor(
+                None, partial(transcode, data, **options)
             )
-        except httpx.HTTPStatusError as e:
-            if e.response.status_code == 404:
-                # Channel does not exist or is private
-                raise ValueError(f"{channel} does not exist or is private")
+        except ImportError:
+            raise
+        except Exception as e:
+            # Not an image that pillow understands, upload it unchanged
+            logger.warning("Could not transcode %s: %s", filename, e)
+        else:
+            filename = filename.rsplit(".", 1)[0] + "." + extension
+    return await upload_file(channel_id, data, filename)
+
+
+async def acquire_channel(channel_id, max_wait=None):
+    """Wait until a post may be made to a channel.
+
+    Posts to every channel are limited to MATTERMOST_CHANNEL_RATE_LIMIT per
+    second, with bursts of up to MATTERMOST_CHANNEL_RATE_BURST. If the post
+    would have to wait longer than max_wait seconds, `RateLimited` is raised.
+    """
+    bucket = _channel_rate_limits.get(channel_id)
+    if bucket is MISSING:
+        bucket = TokenBucket(_channel_rate, _channel_burst)
+    # Refresh the entry so that a waiting channel keeps its bucket
+    _channel_rate_limits.set(channel_id, bucket)
+    with tracing.span("Channel rate limit"):
+        await bucket.acquire(max_wait)
+
+
+async def hub_post_message(
+    message,
+    channel,
+    file_=None,
+    team_name=None,
+    file_ids=(),
+    max_wait=None,
+    pending_post_id=None,
+    rate_limit=True,
+):
+    """Post a message to Mattermost from the JupyterHub service.
+
+    Parameters
+    ----------
+    message : str
+        The message to post.
+    channel : str
+        The channel to post to. If it starts with '@', it is assumed to be a
+        direct message to the user with that username.
+    file_ : bytes or list of bytes, optional
+        A file or files to upload. If given, will be attached to the message.
+        Files may also be given as ``(filename, bytes)`` tuples, by default
+        they are named upload.png. At most `MAX_ATTACHMENTS` files can be
+        attached. Images are transcoded if the service is configured to.
+    team_name : str, optional
+        The name of the team to post to. If not given, will be taken from the
+        MATTERMOST_TEAM environment variable.
+    file_ids : list of str, optional
+        Ids of files already uploaded with `upload_file` to attach.
+    max_wait : float, optional
+        The longest time in seconds to wait for the rate limit of the channel.
+        If the post would have to wait longer, `RateLimited` is raised before
+        the files in ``file_`` are uploaded. Files in ``file_ids`` are already
+        uploaded, so callers should call `acquire_channel` before uploading
+        them. By default there is no limit.
+    pending_post_id : str, optional
+        Passed to Mattermost, which does not create the post again if it
+        receives the same id shortly after, see
+        `IdempotentRequest.pending_post_id`.
+    rate_limit : bool, optional
+        Whether to wait for the rate limit of the channel. Pass False if
+        `acquire_channel` was already called for this post.
+    """
+    team_name = team_name or os.getenv("MATTERMOST_TEAM")
+    if isinstance(file_, bytes):
+        file_ = [file_]
+    files = [f if isinstance(f, tuple) else ("upload.png", f) for f in file_ or ()]
+    files = [(name, data) for name, data in files if data]
+    if len(files) + len(file_ids) > MAX_ATTACHMENTS:
+        raise ValueError(f"At most {MAX_ATTACHMENTS} attachments are allowed")
+    with tracing.span("Resolve channel", **{"jupyterpost.channel": channel}):
+        channel_id = await resolve_channel_id(channel, team_name)
+    if rate_limit:
+        await acquire_channel(channel_id, max_wait)
+
+    # Upload the files
+    with tracing.span("Upload files", **{"jupyterpost.files": len(files)}):
+        file_ids = [
+            *file_ids,
+            *await gather(*(_transcode_and_upload(channel_id, *f) for f in files)),
+        ]
+    post = {"channel_id": channel_id, "message": message, "file_ids": file_ids}
+    if pending_post_id is not None:
+        post["pending_post_id"] = pending_post_id
+    try:
+        return await mm_api_call("post", "posts", json=post)
+    except httpx.HTTPStatusError as e:
+        if e.response.status_code in (403, 404):
+            # The channel was removed or the bot was kicked out of it
+            if channel.startswith("@"):
+                _direct_channel_cache.pop((await get_bot_id(), channel[1:], team_name))
             else:
-                raise
-        # Join the channel (this is idempotent)
-        await mm_api_call(
-            "post", f"channels/{channel['id']}/members", json={"user_id": me}
+                _channel_cache.pop((team_name, channel))
+        raise
+
+
+async def hub_post_many(posts, team_name=None, concurrency=None, max_wait=None):
+    """Post several messages to Mattermost from the JupyterHub service.
+
+    Messages to the same channel are posted one after another in the given
+    order, so that the channel is only resolved once. Different channels are
+    handled concurrently.
+
+    Parameters
+    ----------
+    posts : list of dict
+        The messages to post. Each has the keys ``message`` and ``channel``
+        and optionally ``file_`` and ``pending_post_id``, as the arguments of
+        `hub_post_message`.
+    team_name : str, optional
+        The name of the team to post to. If not given, will be taken from the
+        MATTERMOST_TEAM environment variable.
+    concurrency : int, optional
+        The maximum number of channels to post to at the same time. If not
+        given, will be taken from the JUPYTERPOST_BATCH_CONCURRENCY
+        environment variable, defaulting to 4.
+    max_wait : float, optional
+        The longest time in seconds to spend waiting for the rate limits of
+        the channels. Posts that would be sent later are not sent. By default
+        all posts are sent.
+
+    Returns
+    -------
+    results : list of dict
+        For every post either ``{"post_id": post_id}`` or ``{"error": reason}``,
+        a failing post does not stop the others. Posts that were not sent
+        because of max_wait have the error "Rate limited" and ``retry_after``,
+        the seconds after which to send them again. Later posts to the same
+        channel are not sent either, to keep their order.
+    """
+    if concurrency is None:
+        concurrency = int(os.getenv("JUPYTERPOST_BATCH_CONCURRENCY", 4))
+    deadline = None if max_wait is None else time.monotonic() + max_wait
+    semaphore = asyncio.Semaphore(concurrency)
+    results = [None] * len(posts)
+    by_channel = {}
+    for i, post in enumerate(posts):
+        by_channel.setdefault(post["channel"], []).append(i)
+
+    async def post_to_channel(indices):
+        async with semaphore:
+            for n, i in enumerate(indices):
+                post = posts[i]
+                wait = None if deadline is None else max(deadline - time.monotonic(), 0)
+                try:
+                    response = await hub_post_message(
+                        post["message"],
+                        post["channel"],
+                        post.get("file_"),
+                        team_name,
+                        max_wait=wait,
+                        pending_post_id=post.get("pending_post_id"),
+                    )
+                except RateLimited as e:
+                    for j in indices[n:]:
+                        results[j] = {
+                            "error": "Rate limited",
+                            "retry_after": math.ceil(e.retry_after),
+                        }
+                    return
+                except ValueError as e:
+                    results[i] = {"error": str(e)}
+                except httpx.HTTPStatusError as e:
+                    logger.warning("Posting to %s failed: %s", post["channel"], e)
+                    results[i] = {"error": f"Mattermost error {e.response.status_code}"}
+                except httpx.HTTPError as e:
+                    logger.warning("Posting to %s failed: %r", post["channel"], e)
+                    error = type(e).__name__
+                    results[i] = {"error": f"Could not reach Mattermost: {error}"}
+                except Exception:
+                    # Other posts of the batch may have been posted already
+                    logger.exception("Posting to %s failed", post["channel"])
+                    results[i] = {"error": "Internal error"}
+                else:
+                    results[i] = {"post_id": response["id"]}
+
+    await asyncio.gather(*(post_to_channel(indices) for indices in by_channel.values()))
+    return results
+
+
+def check_quota(username, posts, size):
+    """Count posts by a user against the per-user limits.
+
+    Parameters
+    ----------
+    username : str
+        The JupyterHub user making the request.
+    posts : int
+        The number of posts in the request.
+    size : int
+        The size of the request body in bytes.
+
+    Returns
+    -------
+    wait : int
+        0 if the posts are allowed and were counted, otherwise the number of
+        seconds after which they would be allowed. Posts that are then not
+        made are given back with `release_quota`.
+    """
+    wait = max(
+        _user_post_limit.retry_after(username, posts),
+        _user_byte_limit.retry_after(username, size),
+    )
+    if wait > 0:
+        return math.ceil(wait)
+    _user_post_limit.add(username, posts)
+    _user_byte_limit.add(username, size)
+    return 0
+
+
+def release_quota(username, posts):
+    """Stop counting posts that were refused after `check_quota`.
+
+    Their bytes stay counted, as the service received them.
+    """
+    _user_post_limit.remove(username, posts)
+
+
+def refuse_quota(handler, wait):
+    """Answer a request that exceeds the limits of `check_quota`."""
+    handler.set_status(429)
+    handler.set_header("Retry-After", str(wait))
+    handler.write(f"Too many posts, try again in {wait} s")
+
+
+def sign(username, message):
+    """Prefix a message with the user who sent it and the bot signature."""
+    return f"*@{username} {os.getenv('BOT_SIGNATURE')}*: {message}"
+
+
+def _upload_name(filename):
+    """Return the name to upload a file under, defaulting to upload.png."""
+    filename = os.path.basename(filename or "")
+    return filename if "." in filename.strip(".") else "upload.png"
+
+
+class TracedRequest:
+    """Handler mixin recording each request in a span with the hub username.
+
+    The span is the parent of the spans of the Mattermost API calls made
+    while answering the request, see `jupyterpost.tracing`.
+    """
+
+    _span = None
+
+    def trace_request(self):
+        """Start the span of the request, call at the start of `prepare`."""
+        user = self.current_user
+        self._span = tracing.start_span(
+            f"{self.request.method} {type(self).__name__}",
+            **{
+                "http.request.method": self.request.method,
+                "url.path": self.request.path,
+                "enduser.id": user["name"] if user else "",
+            },
+        )
+        tracing.activate(self._span)
+
+    def on_finish(self):
+        tracing.end_span(self._span, self.get_status())
+        super().on_finish()
+
+
+class IdempotentRequest:
+    """Handler mixin answering repeated requests with the original result.
+
+    Clients send a random Idempotency-Key header with every new post, and the
+    same key when they retry it, so that a retry after a lost response does
+    not post twice. Successful results are remembered per user for
+    JUPYTERPOST_IDEMPOTENCY_TTL seconds. A repeat that arrives while the
+    original is still being handled waits for its result.
+    """
+
+    _idempotency_key = None
+    # Resolves to the status, content type and written chunks of the original
+    # request, or None if it failed.
+    _original = None
+    _result = None
+    _written = None
+    _content_type = None
+    _handling = False
+
+    def check_idempotency(self):
+        """Return whether the request repeats an earlier one.
+
+        Call in `prepare` once the user is known. The body of a repeated
+        request need not be read.
+        """
+        key = self.request.headers.get("Idempotency-Key")
+        if not key:
+            return False
+        if len(key) > 255:
+            raise HTTPError(400, "Idempotency-Key is too long")
+        self._idempotency_key = (self.current_user["name"], key)
+        original = _idempotency_cache.get(self._idempotency_key)
+        if original is not MISSING:
+            self._original = original
+            return True
+        self._result = asyncio.get_running_loop().create_future()
+        self._written = []
+        _idempotency_cache.set(self._idempotency_key, self._result)
+        return False
+
+    async def replay(self):
+        """Answer a repeated request and return True, or return False if new.
+
+        Call at the start of the request method.
+        """
+        if self._original is None:
+            self._handling = True
+            return False
+        result = await asyncio.shield(self._original)
+        if result is None:
+            # Nothing was posted, the client may try again
+            self.set_status(503)
+            self.set_header("Retry-After", "1")
+            self.write("The original request failed, try again")
+            return True
+        status, content_type, chunks = result
+        self.set_status(status)
+        if content_type is not None:
+            self.set_header("Content-Type", content_type)
+        for chunk in chunks:
+            self.write(chunk)
+        return True
+
+    def pending_post_id(self, index=0):
+        """Return the pending_post_id of a post made for this request.
+
+        Mattermost ignores a post with the pending_post_id of one it received
+        shortly before. This keeps a retry from posting twice if the original
+        request posted, but its call to Mattermost failed without an answer.
+        index tells apart several posts of one request. Returns None for
+        requests without an idempotency key.
+        """
+        if self._idempotency_key is None:
+            return None
+        username, key = self._idempotency_key
+        return hashlib.sha256(f"{username}\n{key}\n{index}".encode()).hexdigest()[:32]
+
+    def write(self, chunk):
+        if self._written is not None:
+            self._written.append(chunk)
+        super().write(chunk)
+
+    def set_header(self, name, value):
+        if name == "Content-Type":
+            self._content_type = value
+        super().set_header(name, value)
+
+    def _resolve(self, result):
+        if self._result is not None and not self._result.done():
+            if result is None:
+                _idempotency_cache.pop(self._idempotency_key)
+            self._result.set_result(result)
+
+    def on_finish(self):
+        status = self.get_status()
+        if status in (200, 202):
+            self._resolve((status, self._content_type, self._written))
+        else:
+            self._resolve(None)
+        super().on_finish()
+
+    def on_connection_close(self):
+        if not self._handling:
+            # The body was not received completely, the request is not handled
+            self._resolve(None)
+        super().on_connection_close()
+
+
+@stream_request_body
+class ChatPostHandler(
+    TracedRequest, IdempotentRequest, HubAuthenticated, RequestHandler
+):
+    """Post a message with optional attachments.
+
+    The message and channel are sent as form fields. If the body is
+    multipart, every ``file`` part is streamed to Mattermost while it arrives
+    instead of being buffered, provided that it comes after the channel field.
+    Streaming starts once the rate limit of the channel allows the post, so
+    that posts refused by it leave no uploaded files behind. Posts to be
+    merged must send the ``coalesce`` field before their attachments. Attachments may
+    also be sent base64 encoded as ``file_base64`` parts, so that clients
+    holding base64 data need not decode it first.
+    """
+
+    def initialize(self):
+        self._body = bytearray()
+        self._fields = {}
+        self._files = []
+        self._part = None
+        self._decoder = None
+        self._parser = None
+        self._uploads = []
+        self._channel_id = None
+        self._chunks = None
+        self._error = None
+        self._quota_wait = 0
+        self._quota_user = None
+        self._received = 0
+        self._counted_bytes = 0
+
+    async def prepare(self):
+        if self.request.method != "POST":
+            return
+        if self.current_user is None:
+            raise HTTPError(403)
+        self.trace_request()
+        if self.check_idempotency():
+            # Drop the body, the original result is sent in `post`
+            return
+        username = self.current_user["name"]
+        size = int(self.request.headers.get("Content-Length", 0))
+        self._quota_wait = check_quota(username, 1, size)
+        if self._quota_wait:
+            # Read and drop the body, then refuse in `post`
+            return
+        self._quota_user = username
+        self._counted_bytes = size
+        self.request.connection.set_max_body_size(
+            int(os.getenv("JUPYTERPOST_MAX_UPLOAD_SIZE", 50 * 1024**2))
         )
+        try:
+            boundary = get_boundary(self.request.headers.get("Content-Type", ""))
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+        if boundary is not None:
+            self._parser = MultipartParser(
+                boundary, self._start_part, self._part_data, self._end_part
+            )
 
-    channel_id = channel["id"]
+    async def data_received(self, chunk):
+        if self._quota_wait or self._original is not None:
+            return
+        self._received += len(chunk)
+        if self._received > self._counted_bytes:
+            # The body is longer than announced, or chunked without a length
+            extra = self._received - self._counted_bytes
+            self._quota_wait = check_quota(self._quota_user, 0, extra)
+            if self._quota_wait:
+                self._cancel_uploads()
+                return
+            self._counted_bytes = self._received
+        if self._parser is None:
+            self._body += chunk
+            return
+        if self._error is not None:
+            # Discard the rest of an invalid body
+            return
+        try:
+            # Uploads started here are part of the request's trace
+            with tracing.use_span(self._span):
+                await self._parser.feed(chunk)
+        except ValueError as e:
+            # Raising here would drop the connection, report it in `post`
+            self._error = str(e)
+            self._cancel_uploads()
 
-    if file_:  # Upload the file
-        upload = await mm_api_call(
-            "post",
-            "files",
-            params={"channel_id": channel_id, "filename": "upload.png"},
-            data=file_,
+    def _start_part(self, name, filename):
+        self._part = name
+        # Attachments that are already base64 encoded are decoded here
+        self._decoder = Base64Decoder() if name == "file_base64" else None
+        if name not in ("file", "file_base64"):
+            self._fields[name] = bytearray()
+        elif len(self._uploads) + len(self._files) >= MAX_ATTACHMENTS:
+            raise ValueError(f"At most {MAX_ATTACHMENTS} attachments are allowed")
+        elif "channel" in self._fields and self._can_stream():
+            # Start uploading before the file is fully received
+            self._chunks = asyncio.Queue(maxsize=16)
+            self._uploads.append(
+                asyncio.ensure_future(
+                    self._stream_upload(self._chunks, _upload_name(filename))
+                )
+            )
+        else:
+            # Keep the file until the request is complete, either because the
+            # channel is not known yet, or because it must be transcoded.
+            self._files.append((_upload_name(filename), bytearray()))
+
+    async def _part_data(self, data):
+        if self._decoder is not None:
+            data = self._decoder.decode(data)
+            if not data:
+                return
+        if self._chunks is not None:
+            upload = self._uploads[-1]
+            put = asyncio.ensure_future(self._chunks.put(data))
+            await asyncio.wait([put, upload], return_when=asyncio.FIRST_COMPLETED)
+            if not put.done():
+                # The upload failed, the error is reported once the body is read
+                put.cancel()
+        elif self._part in ("file", "file_base64"):
+            self._files[-1][1].extend(data)
+        else:
+            self._fields[self._part] += data
+            if len(self._fields[self._part]) > 2**20:
+                raise ValueError(f"Form field {self._part} is too long")
+
+    async def _end_part(self):
+        if self._decoder is not None:
+            self._decoder.finish()
+        if self._chunks is not None and not self._uploads[-1].done():
+            await self._chunks.put(None)
+        self._chunks = None
+        if (
+            self._part == "coalesce"
+            and self._fields["coalesce"]
+            and self._uploads
+            and self.settings.get("coalescer") is not None
+        ):
+            # The attachments were passed on already, they cannot be merged
+            raise ValueError("The coalesce field must come before the attachments")
+
+    def _can_stream(self):
+        """Whether attachments can be passed on before the body is complete."""
+        return (
+            image_options() is None
+            and self.settings.get("outbox") is None
+            and not self._fields.get("coalesce")
         )
-        file_ids = [upload["file_infos"][0]["id"]]
-    else:
-        file_ids = []
-    return await mm_api_call(
-        "post",
-        "posts",
-        json={"channel_id": channel_id, "message": message, "file_ids": file_ids},
-    )
 
+    async def _acquire_channel(self):
+        channel_id = await resolve_channel_id(self._fields["channel"].decode())
+        await acquire_channel(channel_id, _channel_max_wait)
+        return channel_id
+
+    async def _stream_upload(self, queue, filename):
+        if self._channel_id is None:
+            # Shared by the uploads, the post waits for the channel only once
+            self._channel_id = asyncio.ensure_future(self._acquire_channel())
+        channel_id = await asyncio.shield(self._channel_id)
+
+        async def chunks():
+            while (chunk := await queue.get()) is not None:
+                yield chunk
+
+        return await upload_file(channel_id, chunks(), filename)
+
+    def _cancel_uploads(self):
+        for upload in self._uploads:
+            upload.cancel()
+        if self._channel_id is not None:
+            self._channel_id.cancel()
+
+    def _release_quota(self):
+        if self._quota_user is not None:
+            release_quota(self._quota_user, 1)
+            self._quota_user = None
+
+    def on_finish(self):
+        if self.get_status() not in (200, 202):
+            # Refused posts do not count against the quota
+            self._release_quota()
+        super().on_finish()
+
+    def on_connection_close(self):
+        """Stop uploading when the request is aborted."""
+        self._cancel_uploads()
+        if not self._handling:
+            self._release_quota()
+        super().on_connection_close()
+
+    def get_form(self):
+        """Return the form fields and the buffered attachments of the body."""
+        if self._parser is None:
+            files = {}
+            parse_body_arguments(
+                self.request.headers.get("Content-Type", ""),
+                bytes(self._body),
+                self.request.body_arguments,
+                files,
+            )
+            for name, values in self.request.body_arguments.items():
+                self.request.arguments.setdefault(name, []).extend(values)
+            return [
+                (_upload_name(f["filename"]), f["body"]) for f in files.get("file", [])
+            ]
+        if self._error is not None:
+            raise ValueError(self._error)
+        if not self._parser.done:
+            raise ValueError("Incomplete multipart body")
+        for name, value in self._fields.items():
+            self.request.arguments.setdefault(name, []).append(bytes(value))
+        return [(name, bytes(data)) for name, data in self._files]
 
-class ChatPostHandler(HubAuthenticated, RequestHandler):
     @authenticated
     async def post(self):
+        if await self.replay():
+            return
         username = self.get_current_user()["name"]
-        message = self.get_argument("message")
-        message = f"*@{username} {os.getenv('BOT_SIGNATURE')}*: {message}"
-        channel = self.get_argument("channel")
-        file_ = self.request.files.get("file", [{"body": None}])[0]["body"]
+        if self._quota_wait:
+            refuse_quota(self, self._quota_wait)
+            return
         try:
-            await hub_post_message(message, channel, file_)
+            files = self.get_form()
+            message = self.get_argument("message")
+            channel = self.get_argument("channel")
+            coalescer = self.settings.get("coalescer")
+            if self.get_argument("coalesce", "") and coalescer is not None:
+                # Check the channel now, sending happens later
+                await resolve_channel_id(channel)
+                coalescer.add((username, channel), message, files)
+                self.set_status(202)
+                self.write({"status": "coalesced"})
+                return
+            message = sign(username, message)
+            outbox = self.settings.get("outbox")
+            if outbox is not None:
+                queue_id = outbox.enqueue(username, message, channel, files)
+                self.set_status(202)
+                self.write({"queue_id": queue_id, "status": "pending"})
+                return
+            file_ids = await gather(*self._uploads)
+            post = await hub_post_message(
+                message,
+                channel,
+                files,
+                file_ids=file_ids,
+                max_wait=_channel_max_wait,
+                pending_post_id=self.pending_post_id(),
+                rate_limit=self._channel_id is None,
+            )
+        except RateLimited as e:
+            refuse_quota(self, math.ceil(e.retry_after))
         except ValueError as e:
             self.set_status(400)
             self.write(str(e))
+        else:
+            self.write({"post_id": post["id"]})
+
+
+def _decode_attachment(attachment):
+    """Return ``(filename, bytes)`` for an attachment in a batch request."""
+    if isinstance(attachment, str):
+        return "upload.png", b64decode(attachment, validate=True)
+    if not isinstance(attachment, dict):
+        raise TypeError("Attachments must be strings or objects")
+    return (
+        _upload_name(attachment.get("filename")),
+        b64decode(attachment["data"], validate=True),
+    )
+
+
+class BatchPostHandler(
+    TracedRequest, IdempotentRequest, HubAuthenticated, RequestHandler
+):
+    """Post a JSON array of messages in one request.
+
+    Every element has the string keys ``channel`` and ``message``, and
+    optionally ``attachments``, a list of base64 encoded pngs. Attachments may
+    also be objects with the keys ``filename`` and ``data``, the latter base64
+    encoded. The response is a JSON array with the result of every post, see
+    `hub_post_many`.
+    """
+
+    def prepare(self):
+        if self.request.method == "POST":
+            self.trace_request()
+            if self.current_user is not None:
+                self.check_idempotency()
+
+    @authenticated
+    async def post(self):
+        if await self.replay():
+            return
+        username = self.get_current_user()["name"]
+        try:
+            items = json.loads(self.request.body)
+            if not isinstance(items, list):
+                raise ValueError("Expected a list of posts")
+            max_batch = int(os.getenv("JUPYTERPOST_MAX_BATCH", 100))
+            if len(items) > max_batch:
+                raise ValueError(f"At most {max_batch} posts are allowed at once")
+            posts = [
+                {
+                    "message": sign(username, item["message"]),
+                    "channel": str(item["channel"]),
+                    "file_": [
+                        _decode_attachment(attachment)
+                        for attachment in item.get("attachments") or ()
+                    ],
+                    "pending_post_id": self.pending_post_id(i),
+                }
+                for i, item in enumerate(items)
+            ]
+        except (ValueError, TypeError, KeyError, binascii.Error) as e:
+            self.set_status(400)
+            self.write(f"Invalid batch: {e!r}")
+            return
+        wait = check_quota(username, len(posts), len(self.request.body))
+        if wait:
+            refuse_quota(self, wait)
+            return
+        outbox = self.settings.get("outbox")
+        if outbox is not None:
+            results = [
+                {
+                    "queue_id": outbox.enqueue(
+                        username, post["message"], post["channel"], post["file_"]
+                    ),
+                    "status": "pending",
+                }
+                for post in posts
+            ]
+            self.set_status(202)
+        else:
+            results = await hub_post_many(posts, max_wait=_channel_max_wait)
+            release_quota(username, sum("error" in result for result in results))
+        self.set_header("Content-Type", "application/json")
+        self.write(json.dumps(results))
+
+
+class MetricsHandler(HubAuthenticated, RequestHandler):
+    """Serve the Prometheus metrics of the service.
+
+    Requires authentication unless JUPYTERPOST_AUTHENTICATE_METRICS is false.
+    """
+
+    def get(self):
+        authenticate = os.getenv("JUPYTERPOST_AUTHENTICATE_METRICS", "true")
+        if authenticate.lower() in ("1", "true", "yes") and self.current_user is None:
+            raise HTTPError(403)
+        outbox = self.settings.get("outbox")
+        if outbox is not None:
+            metrics.QUEUE_DEPTH.set(outbox.depth())
+        data, content_type = metrics.latest()
+        self.set_header("Content-Type", content_type)
+        self.write(data)
+
+
+class StatusHandler(HubAuthenticated, RequestHandler):
+    """Report the status of a queued post to the user who sent it."""
+
+    @authenticated
+    def get(self, queue_id):
+        outbox = self.settings.get("outbox")
+        status = outbox and outbox.status(int(queue_id), self.current_user["name"])
+        if not status:
+            raise HTTPError(404)
+        self.write(status)
+
+
+def open_coalescer(outbox=None):
+    """Create the coalescer for messages sent with ``coalesce`` set.
+
+    Messages are merged during JUPYTERPOST_COALESCE_WINDOW seconds, and
+    coalescing is disabled if that is 0. The merged messages are queued in
+    outbox if it is given, and posted directly otherwise.
+    """
+    window = float(os.getenv("JUPYTERPOST_COALESCE_WINDOW", 10))
+    if not window:
+        return None
+
+    async def send(key, messages, files):
+        username, channel = key
+        message = sign(username, "\n".join(messages))
+        if outbox is not None:
+            outbox.enqueue(username, message, channel, files)
+            return
+        with tracing.span("Send merged posts", **{"enduser.id": username}):
+            await hub_post_message(message, channel, files)
+
+    return Coalescer(window, send, max_files=MAX_ATTACHMENTS)
+
+
+def open_outbox(poll_interval=None):
+    """Open the outbound queue if JUPYTERPOST_QUEUE_PATH is set, else return None.
+
+    poll_interval is passed to `Outbox`, it is needed when several processes
+    share the queue.
+    """
+    path = os.getenv("JUPYTERPOST_QUEUE_PATH")
+    if not path:
+        return None
+
+    async def send(message, channel, files, pending_post_id):
+        with tracing.span("Send queued post"):
+            return await hub_post_message(
+                message, channel, files, pending_post_id=pending_post_id
+            )
+
+    return Outbox(
+        path,
+        send,
+        max_attempts=int(os.getenv("JUPYTERPOST_QUEUE_MAX_ATTEMPTS", 8)),
+        concurrency=int(os.getenv("JUPYTERPOST_BATCH_CONCURRENCY", 4)),
+        poll_interval=poll_interval,
+    )
 
 
 def configure_jupyterhub(
@@ -150,6 +1263,33 @@ def configure_jupyterhub(
     port: int = 10101,
     bot_signature: str = "(via jupyterpost)",
     jupyterpost_url: str = None,
+    max_connections: int = 20,
+    keepalive_expiry: float = 60,
+    http2: bool = False,
+    channel_cache_ttl: float = 600,
+    negative_cache_ttl: float = 60,
+    user_cache_ttl: float = 3600,
+    direct_channel_cache_ttl: float = 3600,
+    max_upload_size: int = 50 * 1024**2,
+    image_format: str = None,
+    image_max_size: int = None,
+    image_quality: int = None,
+    queue_path: str = None,
+    rate_limit: float = 10,
+    rate_burst: int = 100,
+    channel_rate_limit: float = 1,
+    channel_rate_burst: int = 5,
+    channel_max_wait: float = 2,
+    user_posts_per_minute: int = 60,
+    user_bytes_per_hour: int = None,
+    coalesce_window: float = 10,
+    processes: int = 1,
+    metrics_dir: str = None,
+    max_buffer_size: int = None,
+    debug: bool = False,
+    authenticate_metrics: bool = True,
+    trace: str = None,
+    idempotency_ttl: float = 3600,
 ):
     """Configure JupyterHub to use this service.
 
@@ -171,7 +1311,121 @@ def configure_jupyterhub(
     jupyterpost_url : str, optional
         The URL to use for the service. TODO: Should be inferred from the config,
         but this doesn't work well yet.
+    max_connections : int, optional
+        The maximum number of connections the service keeps open to
+        Mattermost. Defaults to 20.
+    keepalive_expiry : float, optional
+        Seconds after which idle connections to Mattermost are closed.
+        Defaults to 60.
+    http2 : bool, optional
+        Whether to talk to Mattermost over HTTP/2. Requires ``httpx[http2]``
+        to be installed in the service environment. Defaults to False.
+    channel_cache_ttl : float, optional
+        Seconds for which channel ids are cached. Defaults to 600.
+    negative_cache_ttl : float, optional
+        Seconds for which channels and users that do not exist are remembered.
+        Defaults to 60.
+    user_cache_ttl : float, optional
+        Seconds for which user ids and their team membership are cached.
+        Defaults to 3600.
+    direct_channel_cache_ttl : float, optional
+        Seconds for which direct channel ids are cached. Defaults to 3600.
+    max_upload_size : int, optional
+        The largest request body in bytes the service accepts, including
+        attachments. Defaults to 50 MiB.
+    image_format : str, optional
+        Convert png attachments to this format, one of "png", "jpeg" or
+        "webp", before uploading them. Requires pillow in the service
+        environment, as do the other image options, the service does not
+        start without it. By default images are uploaded unchanged.
+    image_max_size : int, optional
+        Scale down images that are wider or taller than this many pixels.
+    image_quality : int, optional
+        The quality from 1 to 100 used for "jpeg" and "webp" images.
+    queue_path : str, optional
+        If given, posts are stored in an SQLite database at this path and
+        sent in the background, retrying when Mattermost fails. The service
+        then answers immediately with a queue id whose status can be polled.
+    rate_limit : float, optional
+        The average number of Mattermost API calls per second the service
+        makes. Should match the rate limit of the Mattermost server. Defaults
+        to 10. Calls are also slowed down when Mattermost reports that the
+        limit is reached.
+    rate_burst : int, optional
+        The number of API calls that may be made at once. Defaults to 100.
+    channel_rate_limit : float, optional
+        The average number of posts per second to a single channel. Defaults
+        to 1.
+    channel_rate_burst : int, optional
+        The number of posts to a single channel that may be made at once.
+        Defaults to 5.
+    channel_max_wait : float, optional
+        The longest time in seconds a request waits for the rate limit of a
+        channel. Posts that would wait longer are refused with status 429,
+        and `jupyterpost.post` and `jupyterpost.post_many` send them again
+        after the time the service asks for. Queued and merged posts always
+        wait. Defaults to 2.
+    user_posts_per_minute : int, optional
+        The number of posts a single JupyterHub user may make per minute.
+        Further posts are refused with status 429. Posts refused for other
+        reasons are not counted. Defaults to 60, None disables the limit.
+    user_bytes_per_hour : int, optional
+        The number of bytes, mostly attachments, a single JupyterHub user may
+        send per hour. Uploads are refused once they exceed it, also when
+        they do not announce their length. Unlimited by default.
+    coalesce_window : float, optional
+        Messages that a user sends to the same channel within this many
+        seconds are merged into one post, if the user asks for it with
+        ``coalesce=True``. Defaults to 10, 0 disables merging.
+    processes : int, optional
+        The number of worker processes of the service, sharing its port. 0
+        starts one per CPU. Defaults to 1. The Mattermost rate limit is
+        divided between the processes, while the limits per channel and per
+        user and the merging of messages apply to each process separately.
+        The metrics of all processes are added up, see ``metrics_dir``.
+    metrics_dir : str, optional
+        The directory in which several processes share their metrics. It is
+        emptied when the service starts. Defaults to
+        ``jupyterpost-metrics-<port>`` in the temporary directory. Only used
+        if ``processes`` is not 1.
+    max_buffer_size : int, optional
+        The most bytes of a request the service keeps in memory. Requests
+        that are not streamed, such as batches, must fit. Defaults to the
+        Tornado default of 100 MiB.
+    debug : bool, optional
+        Run the service in Tornado debug mode, which reloads it when its code
+        changes and shows tracebacks in error responses. Always uses a single
+        process. Defaults to False.
+    authenticate_metrics : bool, optional
+        Whether the Prometheus metrics at ``/services/jupyterpost/metrics``
+        require a JupyterHub token with access to the service. Defaults to
+        True.
+    trace : str, optional
+        Record the steps of every request, including each Mattermost API
+        call, as OpenTelemetry spans. "console" writes them to the service
+        log, any other value is a file to append them to as JSON lines.
+        Requires ``opentelemetry-sdk``. If not given, spans are only recorded
+        when OpenTelemetry is set up otherwise, for example by running the
+        service with ``opentelemetry-instrument``.
+    idempotency_ttl : float, optional
+        Seconds for which the result of a post is remembered, so that a
+        client retrying it gets the result instead of posting again.
+        Defaults to 3600. Each service process remembers its own posts.
     """
+    optional_environment = {
+        "JUPYTERPOST_IMAGE_FORMAT": image_format,
+        "JUPYTERPOST_IMAGE_MAX_SIZE": image_max_size,
+        "JUPYTERPOST_IMAGE_QUALITY": image_quality,
+        "JUPYTERPOST_QUEUE_PATH": queue_path,
+        "JUPYTERPOST_USER_POSTS_PER_MINUTE": user_posts_per_minute,
+        "JUPYTERPOST_USER_BYTES_PER_HOUR": user_bytes_per_hour,
+        "JUPYTERPOST_MAX_BUFFER_SIZE": max_buffer_size,
+        "JUPYTERPOST_TRACE": trace,
+    }
+    if processes != 1:
+        optional_environment["PROMETHEUS_MULTIPROC_DIR"] = metrics_dir or os.path.join(
+            tempfile.gettempdir(), f"jupyterpost-metrics-{port}"
+        )
     c.JupyterHub.services.append(
         {
             "name": "jupyterpost",
@@ -182,6 +1436,27 @@ def configure_jupyterhub(
                 "MATTERMOST_URL": mattermost_url,
                 "MATTERMOST_TEAM": mattermost_team,
                 "BOT_SIGNATURE": bot_signature,
+                "MATTERMOST_MAX_CONNECTIONS": str(max_connections),
+                "MATTERMOST_KEEPALIVE_EXPIRY": str(keepalive_expiry),
+                "MATTERMOST_HTTP2": str(http2),
+                "MATTERMOST_CHANNEL_CACHE_TTL": str(channel_cache_ttl),
+                "MATTERMOST_NEGATIVE_CACHE_TTL": str(negative_cache_ttl),
+                "MATTERMOST_USER_CACHE_TTL": str(user_cache_ttl),
+                "MATTERMOST_DIRECT_CHANNEL_CACHE_TTL": str(direct_channel_cache_ttl),
+                "JUPYTERPOST_MAX_UPLOAD_SIZE": str(max_upload_size),
+                "MATTERMOST_RATE_LIMIT": str(rate_limit),
+                "MATTERMOST_RATE_BURST": str(rate_burst),
+                "MATTERMOST_CHANNEL_RATE_LIMIT": str(channel_rate_limit),
+                "MATTERMOST_CHANNEL_RATE_BURST": str(channel_rate_burst),
+                "MATTERMOST_CHANNEL_MAX_WAIT": str(channel_max_wait),
+                "JUPYTERPOST_COALESCE_WINDOW": str(coalesce_window),
+                "JUPYTERPOST_PROCESSES": str(processes),
+                "JUPYTERPOST_DEBUG": str(debug),
+                "JUPYTERPOST_AUTHENTICATE_METRICS": str(authenticate_metrics),
+                "JUPYTERPOST_IDEMPOTENCY_TTL": str(idempotency_ttl),
+                **{
+                    k: str(v) for k, v in optional_environment.items() if v is not None
+                },
             },
         }
     )
@@ -206,21 +1481,137 @@ def configure_jupyterhub(
     }
 
 
-def main():
-    app = Application(
+def make_app(prefix, **settings):
+    """Create the service application.
+
+    Parameters
+    ----------
+    prefix : str
+        The URL prefix of the service, JUPYTERHUB_SERVICE_PREFIX.
+    **settings
+        Passed to the Tornado application. The handlers use ``outbox`` and
+        ``coalescer``, see `open_outbox` and `open_coalescer`.
+    """
+    return Application(
         [
-            (os.environ["JUPYTERHUB_SERVICE_PREFIX"] + "/?", ChatPostHandler),
+            (prefix.rstrip("/") + "/batch/?", BatchPostHandler),
+            (prefix.rstrip("/") + r"/status/(\d+)/?", StatusHandler),
+            (prefix.rstrip("/") + "/metrics/?", MetricsHandler),
+            (prefix + "/?", ChatPostHandler),
             (r".*", ChatPostHandler),
         ],
-        autoreload=True,
-        debug=True,
+        log_function=metrics.log_request,
+        **settings,
     )
-    http_server = HTTPServer(app)
+
+
+async def _check_mattermost():
+    """Run `connect_mattermost` with a client that is closed afterwards."""
+    open_mm_client()
+    try:
+        await connect_mattermost()
+    finally:
+        await close_mm_client()
+
+
+def _stop_if_orphaned(parent):
+    """Stop a worker process whose parent has exited."""
+    if os.getppid() != parent:
+        logger.info("Parent process exited, stopping")
+        IOLoop.current().stop()
+
+
+def _clear_metrics(path):
+    """Remove the metrics of earlier runs of the service from path."""
+    own = f"_{os.getpid()}.db"
+    for name in os.listdir(path):
+        if name.endswith(".db") and not name.endswith(own):
+            os.remove(os.path.join(path, name))
+
+
+def main():
+    """Run the service.
+
+    By default a single process serves requests. Set JUPYTERPOST_PROCESSES to
+    fork several workers sharing the port, 0 for one per CPU, and
+    PROMETHEUS_MULTIPROC_DIR to add up their metrics. Set JUPYTERPOST_DEBUG
+    to run in Tornado debug mode with autoreload, and JUPYTERPOST_TRACE to
+    "console" or a file path to export traces there.
+    """
+    prefix = os.environ["JUPYTERHUB_SERVICE_PREFIX"]
+    debug = os.getenv("JUPYTERPOST_DEBUG", "").lower() in ("1", "true", "yes")
+    processes = int(os.getenv("JUPYTERPOST_PROCESSES", 1))
+    if processes <= 0:
+        processes = cpu_count()
+    if debug and processes > 1:
+        logger.warning("Debug mode does not support multiple processes, using one")
+        processes = 1
+    if metrics.multiprocess_dir():
+        _clear_metrics(metrics.multiprocess_dir())
+    elif processes > 1:
+        logger.warning(
+            "Set PROMETHEUS_MULTIPROC_DIR to add up the metrics of the processes,"
+            " otherwise every process reports its own"
+        )
+    options = image_options()
+    if options is not None:
+        # Otherwise every post with an image would fail
+        try:
+            import PIL  # noqa: F401
+        except ImportError:
+            raise SystemExit(
+                "jupyterpost needs pillow for the image options, "
+                "install jupyterpost[images]"
+            )
+        image_format = options.get("format", "png")
+        if image_format.lower() not in FORMATS:
+            raise SystemExit(f"jupyterpost cannot convert images to {image_format}")
+    # Check the token and team before forking, workers that fail on startup
+    # would be restarted again and again. The ids found are inherited.
+    try:
+        asyncio.run(_check_mattermost())
+    except (RuntimeError, httpx.HTTPError) as e:
+        raise SystemExit(f"jupyterpost could not connect to Mattermost: {e}")
     url = urlparse(os.environ["JUPYTERHUB_SERVICE_URL"])
+    sockets = bind_sockets(url.port, url.hostname)
+    if processes > 1:
+        parent = os.getpid()
+        task_id = fork_processes(processes)
+        PeriodicCallback(partial(_stop_if_orphaned, parent), 1000).start()
+        # The Mattermost rate limit applies to the service as a whole
+        _rate_limit.rate /= processes
+        _rate_limit.burst = max(_rate_limit.burst // processes, 1)
+    else:
+        task_id = 0
 
-    http_server.listen(url.port, url.hostname)
+    if os.getenv("JUPYTERPOST_TRACE"):
+        tracing.configure(os.environ["JUPYTERPOST_TRACE"])
+    outbox = open_outbox(poll_interval=1 if processes > 1 else None)
+    coalescer = open_coalescer(outbox)
+    app = make_app(prefix, debug=debug, outbox=outbox, coalescer=coalescer)
+    metrics.register_cache_stats(cache_stats)
+    max_buffer_size = os.getenv("JUPYTERPOST_MAX_BUFFER_SIZE")
+    http_server = HTTPServer(
+        app,
+        max_buffer_size=max_buffer_size and int(max_buffer_size),
+        max_body_size=int(os.getenv("JUPYTERPOST_MAX_UPLOAD_SIZE", 50 * 1024**2)),
+    )
+    http_server.add_sockets(sockets)
 
-    IOLoop.current().start()
+    open_mm_client()
+    if outbox is not None and task_id == 0:
+        # A single worker sends the queued posts of all processes
+        IOLoop.current().spawn_callback(outbox.run)
+    try:
+        IOLoop.current().start()
+    finally:
+        http_server.stop()
+        if coalescer is not None:
+            IOLoop.current().run_sync(coalescer.flush_all)
+        IOLoop.current().run_sync(close_mm_client)
+        if outbox is not None:
+            outbox.close()
+        tracing.shutdown()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,207 @@
+"""Measure the throughput of the service with simulated JupyterHub users.
+
+By default the real service handlers run in this process, talking to the fake
+Mattermost of `jupyterpost.fake_mattermost`, and users are identified by their
+token without asking JupyterHub. With ``--url`` and ``--token`` a running
+service is tested instead, for example one whose MATTERMOST_URL points to a
+separately started fake Mattermost.
+
+Run ``python -m jupyterpost.loadtest --help`` for the options.
+"""
+import argparse
+import asyncio
+from collections import Counter
+import logging
+import os
+import statistics
+import time
+
+import httpx
+from jupyterhub.services.auth import HubAuth
+from tornado.httpserver import HTTPServer
+from tornado.netutil import bind_sockets
+
+from . import fake_mattermost
+
+
+def listen(app):
+    """Serve app on a free local port and return the server and its URL."""
+    sockets = bind_sockets(0, "127.0.0.1")
+    server = HTTPServer(app)
+    server.add_sockets(sockets)
+    return server, f"http://127.0.0.1:{sockets[0].getsockname()[1]}"
+
+
+def configure_service(mattermost_url, limits=False):
+    """Set the environment from which the service reads its configuration.
+
+    The service reads most of it on import, so this must be called before
+    `jupyterpost.jupyterpost` is imported. Unless limits is True, the rate
+    limits and quotas are lifted so that the service itself is measured.
+    """
+    os.environ.update(
+        MATTERMOST_URL=mattermost_url,
+        MATTERMOST_TOKEN="token",
+        MATTERMOST_TEAM="team",
+        BOT_SIGNATURE="(via jupyterpost)",
+    )
+    if not limits:
+        os.environ.update(
+            MATTERMOST_RATE_LIMIT="1e9",
+            MATTERMOST_RATE_BURST="1000000000",
+            MATTERMOST_CHANNEL_RATE_LIMIT="1e9",
+            MATTERMOST_CHANNEL_RATE_BURST="1000000000",
+            JUPYTERPOST_USER_POSTS_PER_MINUTE="",
+            JUPYTERPOST_USER_BYTES_PER_HOUR="",
+        )
+
+
+class TokenAuth(HubAuth):
+    """Take the token of a request as the username, without asking JupyterHub."""
+
+    def get_user(self, handler):
+        token = handler.request.headers.get("Authorization", "")
+        return {"name": token.split()[-1], "kind": "user"} if token else None
+
+
+def use_token_auth():
+    """Make the service handlers authenticate users with `TokenAuth`."""
+    TokenAuth.instance(api_token="loadtest", api_url="http://127.0.0.1/hub/api")
+
+
+async def start_service(mattermost_url, limits=False):
+    """Run the service handlers in this process and return the server and URL.
+
+    Users are not checked with JupyterHub, the token is taken as the username.
+    limits is passed to `configure_service`.
+    """
+    configure_service(mattermost_url, limits)
+    # Read after the configuration above is set
+    from . import jupyterpost
+
+    use_token_auth()
+    jupyterpost.open_mm_client()
+    await jupyterpost.connect_mattermost()
+    return listen(jupyterpost.make_app("/services/jupyterpost/"))
+
+
+async def simulate_user(url, token, channel, posts, deadline, attachment, results):
+    """Post like a hub user would, recording the latency and status of posts."""
+    async with httpx.AsyncClient(
+        headers={"Authorization": f"token {token}"}, timeout=60
+    ) as client:
+        for i in range(posts):
+            if time.monotonic() > deadline:
+                break
+            start = time.perf_counter()
+            try:
+                response = await client.post(
+                    url,
+                    data={"message": f"Load test post {i}", "channel": channel},
+                    files=attachment and [("file", ("upload.png", attachment))],
+                )
+                status = response.status_code
+            except httpx.HTTPError as e:
+                status = type(e).__name__
+            results.append((time.perf_counter() - start, status))
+
+
+def report(results, duration, mattermost_stats=None):
+    """Print the throughput and latency percentiles of the results."""
+    latencies = sorted(latency for latency, status in results if status == 200)
+    statuses = Counter(status for _, status in results)
+    print(f"posts      {len(latencies)} of {len(results)} sent in {duration:.2f} s")
+    print(f"throughput {len(latencies) / duration:.1f} posts/s")
+    if len(latencies) >= 2:
+        percentiles = statistics.quantiles(latencies, n=100, method="inclusive")
+        print(
+            f"latency    p50 {percentiles[49] * 1e3:.1f} ms"
+            f"  p95 {percentiles[94] * 1e3:.1f} ms"
+            f"  p99 {percentiles[98] * 1e3:.1f} ms"
+            f"  max {latencies[-1] * 1e3:.1f} ms"
+        )
+    errors = {status: n for status, n in statuses.items() if status != 200}
+    if errors:
+        print(f"errors     {errors}")
+    if mattermost_stats is not None:
+        print(f"mattermost {dict(mattermost_stats)}")
+
+
+async def run(args):
+    mattermost = service = None
+    mattermost_stats = None
+    if args.url is None:
+        app = fake_mattermost.make_app(error_status=args.error_status)
+        mattermost, mattermost_url = listen(app)
+        service, url = await start_service(mattermost_url + "/api/v4/", args.limits)
+        # Slow down and break Mattermost only once the service is running
+        app.settings.update(
+            latency=args.latency, jitter=args.jitter, error_rate=args.error_rate
+        )
+        mattermost_stats = app.settings["stats"]
+        url += "/services/jupyterpost/"
+        tokens = [f"user{i}" for i in range(args.users)]
+    else:
+        url = args.url
+        tokens = args.token or [os.environ["JUPYTERHUB_API_TOKEN"]]
+    attachment = os.urandom(args.attachment_size) if args.attachment_size else None
+    results = []
+    start = time.monotonic()
+    deadline = start + (args.duration or float("inf"))
+    await asyncio.gather(
+        *(
+            simulate_user(
+                url,
+                tokens[i % len(tokens)],
+                f"@{tokens[i % len(tokens)]}" if args.direct else args.channel,
+                args.posts,
+                deadline,
+                attachment,
+                results,
+            )
+            for i in range(args.users)
+        )
+    )
+    report(results, time.monotonic() - start, mattermost_stats)
+    for server in (service, mattermost):
+        if server is not None:
+            server.stop()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Post from many simulated JupyterHub users at once."
+    )
+    parser.add_argument("-u", "--users", type=int, default=10)
+    parser.add_argument("-n", "--posts", type=int, default=100, help="posts per user")
+    parser.add_argument("-d", "--duration", type=float, help="stop after seconds")
+    parser.add_argument("--channel", default="town-square")
+    parser.add_argument(
+        "--direct", action="store_true", help="post to every user directly"
+    )
+    parser.add_argument("--attachment-size", type=int, default=0, help="bytes")
+    parser.add_argument("--url", help="test a running service at this URL")
+    parser.add_argument(
+        "--token",
+        action="append",
+        help="API tokens of the users with --url, defaults to JUPYTERHUB_API_TOKEN",
+    )
+    parser.add_argument(
+        "--limits",
+        action="store_true",
+        help="keep the configured rate limits and quotas of the service",
+    )
+    fake = parser.add_argument_group("fake Mattermost, without --url")
+    fake.add_argument("--latency", type=float, default=0, help="seconds")
+    fake.add_argument("--jitter", type=float, default=0, help="seconds")
+    fake.add_argument("--error-rate", type=float, default=0)
+    fake.add_argument("--error-status", type=int, default=503)
+    args = parser.parse_args()
+    # Keep the log of every request out of the report, errors are counted
+    logging.getLogger("tornado.access").setLevel(logging.CRITICAL)
+    logging.getLogger("tornado.application").setLevel(logging.CRITICAL)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,204 @@
+"""Prometheus metrics of the jupyterpost service.
+
+The metrics are registered in `REGISTRY` and served by `MetricsHandler`.
+It is separate from the default prometheus_client registry, which also
+holds the metrics of JupyterHub once it is imported.
+
+With several service processes, PROMETHEUS_MULTIPROC_DIR is set, see
+`jupyterpost.configure_jupyterhub`. prometheus_client then keeps the metrics
+of every process in files in that directory, and the process answering a
+scrape reports the sum of all of them. Only its own cache statistics are
+reported, labelled with its pid.
+"""
+import os
+
+from prometheus_client import CollectorRegistry, Counter, Gauge, Histogram
+from prometheus_client.core import CounterMetricFamily, GaugeMetricFamily
+from prometheus_client.exposition import CONTENT_TYPE_LATEST, generate_latest
+from prometheus_client.multiprocess import MultiProcessCollector
+from tornado.log import access_log
+
+REGISTRY = CollectorRegistry()
+
+REQUEST_DURATION = Histogram(
+    "jupyterpost_request_duration_seconds",
+    "Time to answer requests to the service",
+    ["handler", "method", "code"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+    registry=REGISTRY,
+)
+MATTERMOST_DURATION = Histogram(
+    "jupyterpost_mattermost_request_duration_seconds",
+    "Time taken by Mattermost API calls, by endpoint",
+    ["method", "endpoint", "code"],
+    buckets=(0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60),
+    registry=REGISTRY,
+)
+ERRORS = Counter(
+    "jupyterpost_errors_total",
+    "Error responses of the service and of Mattermost, by status code",
+    ["origin", "code"],
+    registry=REGISTRY,
+)
+UPLOAD_SIZE = Histogram(
+    "jupyterpost_upload_size_bytes",
+    "Size of the files uploaded to Mattermost",
+    buckets=[4**i * 1024 for i in range(1, 10)],
+    registry=REGISTRY,
+)
+QUEUE_DELAY = Histogram(
+    "jupyterpost_queue_delay_seconds",
+    "Time from queueing a post until it is delivered",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 300, 900, 3600, 4 * 3600),
+    registry=REGISTRY,
+)
+QUEUE_DEPTH = Gauge(
+    "jupyterpost_queue_depth",
+    "Number of queued posts waiting to be sent",
+    # All processes see the same queue, the latest value is right
+    multiprocess_mode="mostrecent",
+    registry=REGISTRY,
+)
+
+# Parts of Mattermost API paths that are not ids or names
+_STATIC_SEGMENTS = {
+    "channels",
+    "direct",
+    "files",
+    "me",
+    "members",
+    "name",
+    "posts",
+    "teams",
+    "username",
+    "users",
+}
+
+
+def endpoint(path):
+    """Return a Mattermost API path with ids and names replaced by ``*``.
+
+    This keeps the number of distinct metric labels small.
+    """
+    segments = path.split("?", 1)[0].strip("/").split("/")
+    return "/".join(
+        segment
+        if segment in _STATIC_SEGMENTS and previous not in ("name", "username")
+        else "*"
+        for previous, segment in zip([None, *segments], segments)
+    )
+
+
+def observe_mattermost(method, path, code, duration):
+    """Record a Mattermost API call, code is "error" if it failed to complete."""
+    code = str(code)
+    MATTERMOST_DURATION.labels(method.upper(), endpoint(path), code).observe(duration)
+    if code == "error" or int(code) >= 400:
+        ERRORS.labels("mattermost", code).inc()
+
+
+def log_request(handler):
+    """Record the duration of a request and write it to the access log.
+
+    Used as the ``log_function`` of the service application.
+    """
+    status = handler.get_status()
+    duration = handler.request.request_time()
+    REQUEST_DURATION.labels(
+        type(handler).__name__, handler.request.method, str(status)
+    ).observe(duration)
+    if status >= 400:
+        ERRORS.labels("service", str(status)).inc()
+    if status < 400:
+        log_method = access_log.info
+    elif status < 500:
+        log_method = access_log.warning
+    else:
+        log_method = access_log.error
+    log_method(
+        "%d %s %s (%s) %.2fms",
+        status,
+        handler.request.method,
+        handler.request.uri,
+        handler.request.remote_ip,
+        1000 * duration,
+    )
+
+
+class CacheCollector:
+    """Report the hits, misses and sizes of the service caches.
+
+    Parameters
+    ----------
+    stats : callable
+        Returns the statistics, see `jupyterpost.jupyterpost.cache_stats`.
+    pid : int, optional
+        Added as a label, so that the caches of several processes are told
+        apart.
+    """
+
+    def __init__(self, stats, pid=None):
+        self.stats = stats
+        self.pid = pid
+
+    def collect(self):
+        labels = ["cache"] if self.pid is None else ["cache", "pid"]
+        extra = [] if self.pid is None else [str(self.pid)]
+        hits = CounterMetricFamily(
+            "jupyterpost_cache_hits", "Cache lookups that were found", labels=labels
+        )
+        misses = CounterMetricFamily(
+            "jupyterpost_cache_misses",
+            "Cache lookups that were not found",
+            labels=labels,
+        )
+        size = GaugeMetricFamily(
+            "jupyterpost_cache_size", "Number of cached entries", labels=labels
+        )
+        for name, stats in self.stats().items():
+            hits.add_metric([name, *extra], stats["hits"])
+            misses.add_metric([name, *extra], stats["misses"])
+            size.add_metric([name, *extra], stats["size"])
+        return [hits, misses, size]
+
+
+class ServiceCollector:
+    """Report the metrics of all service processes, read from their files.
+
+    The files also hold the metrics of JupyterHub, which are left out.
+    """
+
+    def __init__(self, path):
+        self._collector = MultiProcessCollector(None, path)
+
+    def collect(self):
+        return [
+            metric
+            for metric in self._collector.collect()
+            if metric.name.startswith("jupyterpost_")
+        ]
+
+
+def multiprocess_dir():
+    """Return the directory of the metrics of all processes, or None."""
+    return os.getenv("PROMETHEUS_MULTIPROC_DIR") or None
+
+
+if multiprocess_dir():
+    _SERVED = CollectorRegistry()
+    _SERVED.register(ServiceCollector(multiprocess_dir()))
+else:
+    _SERVED = REGISTRY
+
+
+def register_cache_stats(stats):
+    """Add the cache statistics returned by stats to the metrics."""
+    if _SERVED is REGISTRY:
+        REGISTRY.register(CacheCollector(stats))
+    else:
+        _SERVED.register(CacheCollector(stats, pid=os.getpid()))
+
+
+def latest():
+    """Return the current metrics and their content type."""
+    return generate_latest(_SERVED), CONTENT_TYPE_LATEST
@@ -0,0 +1,141 @@
+"""Incremental parser for multipart/form-data request bodies.
+
+Tornado only parses multipart bodies once they are fully received. This parser
+processes the body chunk by chunk, so that uploaded files can be passed on
+without keeping them in memory. Base64 encoded parts can be decoded on the fly
+with `Base64Decoder`.
+"""
+from base64 import b64decode
+import binascii
+import re
+
+from tornado.httputil import HTTPHeaders
+
+_NAME = re.compile(r'\bname="([^"]*)"')
+_FILENAME = re.compile(r'\bfilename="([^"]*)"')
+
+
+def get_boundary(content_type):
+    """Return the multipart boundary from a Content-Type header, or None."""
+    if not content_type.startswith("multipart/form-data"):
+        return None
+    match = re.search(r'boundary=(?:"([^"]+)"|([^;\s]+))', content_type)
+    if match is None:
+        raise ValueError("Multipart body without boundary")
+    return (match.group(1) or match.group(2)).encode()
+
+
+class MultipartParser:
+    """Split a multipart body into parts as it arrives.
+
+    Parameters
+    ----------
+    boundary : bytes
+        The boundary from the Content-Type header.
+    on_part : callable
+        Called as ``on_part(name, filename)`` when a part starts. ``filename``
+        is None for ordinary form fields.
+    on_data : callable
+        Called with every piece of the body of the current part.
+    on_part_end : callable
+        Called when the current part is complete.
+
+    The callbacks may be coroutine functions, `feed` awaits them in order.
+    """
+
+    def __init__(self, boundary, on_part, on_data, on_part_end):
+        self._first = b"--" + boundary
+        self._delimiter = b"\r\n--" + boundary
+        self._on_part = on_part
+        self._on_data = on_data
+        self._on_part_end = on_part_end
+        self._buffer = bytearray()
+        self._state = "preamble"
+
+    @property
+    def done(self):
+        """Whether the closing boundary has been seen."""
+        return self._state == "done"
+
+    async def feed(self, chunk):
+        """Process the next chunk of the body."""
+        self._buffer += chunk
+        while True:
+            if self._state == "preamble":
+                start = self._buffer.find(self._first)
+                if start < 0:
+                    return
+                del self._buffer[: start + len(self._first)]
+                self._state = "delimiter"
+            elif self._state == "delimiter":
+                if len(self._buffer) < 2:
+                    return
+                ending = bytes(self._buffer[:2])
+                del self._buffer[:2]
+                if ending == b"--":
+                    self._state = "done"
+                elif ending == b"\r\n":
+                    self._state = "headers"
+                else:
+                    raise ValueError("Malformed multipart boundary")
+            elif self._state == "headers":
+                end = self._buffer.find(b"\r\n\r\n")
+                if end < 0:
+                    return
+                headers = HTTPHeaders.parse(self._buffer[:end].decode("utf-8"))
+                del self._buffer[: end + 4]
+                disposition = headers.get("Content-Disposition", "")
+                name = _NAME.search(disposition)
+                if name is None:
+                    raise ValueError("Multipart part without a name")
+                filename = _FILENAME.search(disposition)
+                await _call(
+                    self._on_part, name.group(1), filename and filename.group(1)
+                )
+                self._state = "body"
+            elif self._state == "body":
+                end = self._buffer.find(self._delimiter)
+                if end < 0:
+                    # Keep enough to recognize a delimiter split over chunks.
+                    keep = len(self._delimiter) - 1
+                    if len(self._buffer) > keep:
+                        data = bytes(self._buffer[:-keep])
+                        del self._buffer[:-keep]
+                        await _call(self._on_data, data)
+                    return
+                if end:
+                    await _call(self._on_data, bytes(self._buffer[:end]))
+                del self._buffer[: end + len(self._delimiter)]
+                await _call(self._on_part_end)
+                self._state = "delimiter"
+            else:  # done, ignore the epilogue
+                self._buffer.clear()
+                return
+
+
+async def _call(callback, *args):
+    result = callback(*args)
+    if hasattr(result, "__await__"):
+        await result
+
+
+class Base64Decoder:
+    """Decode base64 data that arrives in pieces of arbitrary length."""
+
+    def __init__(self):
+        self._rest = b""
+
+    def decode(self, data):
+        """Return the bytes that can be decoded from data so far."""
+        data = self._rest + b"".join(data.split())
+        usable = len(data) - len(data) % 4
+        self._rest = data[usable:]
+        try:
+            return b64decode(data[:usable], validate=True)
+        except binascii.Error as e:
+            raise ValueError(f"Invalid base64 data: {e}")
+
+    def finish(self):
+        """Check that no incomplete data is left."""
+        if self._rest:
+            raise ValueError("Truncated base64 data")
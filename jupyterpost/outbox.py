@@ -0,0 +1,246 @@
+"""A durable queue of outgoing posts, stored in SQLite.
+
+Queued posts survive restarts of the service. A worker sends them to
+Mattermost, retrying failures with exponential backoff, and keeps posts to the
+same channel in order. Every attempt to send a post carries the same
+pending_post_id, so that Mattermost does not create it twice if an answer was
+lost and the post is sent again within about 30 seconds.
+"""
+import asyncio
+import hashlib
+import logging
+import sqlite3
+import time
+
+import httpx
+
+from . import metrics
+
+logger = logging.getLogger("jupyterpost")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS posts (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    username TEXT NOT NULL,
+    channel TEXT NOT NULL,
+    message TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    created REAL NOT NULL,
+    error TEXT,
+    post_id TEXT
+);
+CREATE INDEX IF NOT EXISTS posts_pending ON posts (status, channel, id);
+CREATE TABLE IF NOT EXISTS files (
+    post INTEGER NOT NULL REFERENCES posts (id) ON DELETE CASCADE,
+    position INTEGER NOT NULL,
+    filename TEXT NOT NULL,
+    data BLOB NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_post ON files (post);
+"""
+
+
+class Outbox:
+    """Store posts on disk and send them to Mattermost in the background.
+
+    Parameters
+    ----------
+    path : str
+        The SQLite database file.
+    send : coroutine function
+        Called as ``send(message, channel, files, pending_post_id)`` to post,
+        where files is a list of ``(filename, bytes)`` and pending_post_id is
+        the same for every attempt to send a post. Returns the Mattermost post.
+    max_attempts : int, optional
+        How often to try sending a post before giving up.
+    backoff : float, optional
+        Seconds to wait after the first failure, doubled after every next one.
+    max_backoff : float, optional
+        The longest wait between attempts in seconds.
+    concurrency : int, optional
+        The number of channels that are posted to at the same time.
+    retention : float, optional
+        Seconds for which finished posts are kept, so that their status can be
+        queried.
+    poll_interval : float, optional
+        Seconds between checks for posts queued by other processes using the
+        same database. By default only `enqueue` on this object wakes `run`.
+    """
+
+    def __init__(
+        self,
+        path,
+        send,
+        max_attempts=8,
+        backoff=2,
+        max_backoff=300,
+        concurrency=4,
+        retention=86400,
+        poll_interval=None,
+    ):
+        self.send = send
+        self.max_attempts = max_attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.concurrency = concurrency
+        self.retention = retention
+        self.poll_interval = poll_interval
+        self._db = sqlite3.connect(path, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA foreign_keys=ON")
+        self._db.executescript(_SCHEMA)
+        self._wakeup = asyncio.Event()
+
+    def enqueue(self, username, message, channel, files=()):
+        """Store a post to be sent and return its queue id."""
+        now = time.time()
+        with self._db:
+            self._db.execute("BEGIN")
+            post = self._db.execute(
+                "INSERT INTO posts (username, channel, message, next_attempt, created)"
+                " VALUES (?, ?, ?, ?, ?)",
+                (username, channel, message, now, now),
+            ).lastrowid
+            self._db.executemany(
+                "INSERT INTO files (post, position, filename, data)"
+                " VALUES (?, ?, ?, ?)",
+                [(post, i, name, data) for i, (name, data) in enumerate(files)],
+            )
+        self._wakeup.set()
+        return post
+
+    def status(self, post, username=None):
+        """Return the status of a queued post, or None if it is unknown.
+
+        If username is given, only posts queued by that user are returned.
+        """
+        row = self._db.execute(
+            "SELECT username, status, attempts, error, post_id FROM posts"
+            " WHERE id = ?",
+            (post,),
+        ).fetchone()
+        if row is None or (username is not None and row[0] != username):
+            return None
+        status, attempts, error, post_id = row[1:]
+        return {
+            "id": post,
+            "status": status,
+            "attempts": attempts,
+            "error": error,
+            "post_id": post_id,
+        }
+
+    def depth(self):
+        """Return the number of posts waiting to be sent."""
+        return self._db.execute(
+            "SELECT COUNT(*) FROM posts WHERE status IN ('pending', 'sending')"
+        ).fetchone()[0]
+
+    def _due(self, now):
+        """Return the oldest pending post of every channel that is due."""
+        return self._db.execute(
+            "SELECT id, channel, message, created FROM posts AS p"
+            " WHERE status = 'pending' AND next_attempt <= ? AND id = ("
+            "   SELECT MIN(id) FROM posts AS q"
+            "   WHERE q.status IN ('pending', 'sending') AND q.channel = p.channel"
+            " ) ORDER BY id LIMIT ?",
+            (now, self.concurrency),
+        ).fetchall()
+
+    def _next_attempt(self):
+        row = self._db.execute(
+            "SELECT MIN(next_attempt) FROM posts WHERE status = 'pending'"
+        ).fetchone()
+        return row[0]
+
+    async def _deliver(self, post, channel, message, created):
+        files = self._db.execute(
+            "SELECT filename, data FROM files WHERE post = ? ORDER BY position",
+            (post,),
+        ).fetchall()
+        pending_post_id = hashlib.sha256(f"{post}\n{created}".encode()).hexdigest()
+        try:
+            response = await self.send(message, channel, files, pending_post_id[:32])
+        except Exception as e:
+            self._failed(post, e)
+        else:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.execute(
+                    "UPDATE posts SET status = 'sent', post_id = ?, error = NULL"
+                    " WHERE id = ?",
+                    (response["id"], post),
+                )
+                self._db.execute("DELETE FROM files WHERE post = ?", (post,))
+            metrics.QUEUE_DELAY.observe(time.time() - created)
+
+    def _failed(self, post, error):
+        attempts = self._db.execute(
+            "SELECT attempts FROM posts WHERE id = ?", (post,)
+        ).fetchone()[0] + 1
+        retry = isinstance(error, httpx.TransportError) or (
+            isinstance(error, httpx.HTTPStatusError)
+            and (
+                error.response.status_code >= 500
+                or error.response.status_code == 429
+            )
+        )
+        if retry and attempts < self.max_attempts:
+            delay = min(self.backoff * 2 ** (attempts - 1), self.max_backoff)
+            logger.info("Retrying queued post %s in %.0f s: %s", post, delay, error)
+            status, next_attempt = "pending", time.time() + delay
+        else:
+            logger.warning("Giving up on queued post %s: %r", post, error)
+            status, next_attempt = "failed", time.time()
+        self._db.execute(
+            "UPDATE posts SET status = ?, attempts = ?, next_attempt = ?, error = ?"
+            " WHERE id = ?",
+            (status, attempts, next_attempt, str(error), post),
+        )
+
+    def purge(self):
+        """Forget finished posts older than the retention time."""
+        self._db.execute(
+            "DELETE FROM posts WHERE status IN ('sent', 'failed') AND created < ?",
+            (time.time() - self.retention,),
+        )
+
+    async def run(self):
+        """Send queued posts until cancelled.
+
+        Only one process may run this for the same database.
+        """
+        # Posts being sent when the service stopped may or may not have been
+        # delivered. Sending them again is preferred over losing them, and
+        # Mattermost ignores them if it created them shortly before.
+        self._db.execute("UPDATE posts SET status = 'pending' WHERE status = 'sending'")
+        last_purge = 0
+        while True:
+            now = time.time()
+            if now - last_purge > 3600:
+                self.purge()
+                last_purge = now
+            self._wakeup.clear()
+            due = self._due(now)
+            if due:
+                self._db.executemany(
+                    "UPDATE posts SET status = 'sending' WHERE id = ?",
+                    [(post,) for post, *_ in due],
+                )
+                await asyncio.gather(*(self._deliver(*row) for row in due))
+                continue
+            next_attempt = self._next_attempt()
+            timeout = None if next_attempt is None else max(next_attempt - now, 0)
+            poll = self.poll_interval
+            if poll is not None and (timeout is None or timeout > poll):
+                timeout = poll
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    def close(self):
+        """Close the database."""
+        self._db.close()
@@ -0,0 +1,163 @@
+"""Rate limits on requests to Mattermost and on posts by users."""
+import asyncio
+from collections import deque
+import time
+
+
+class RateLimited(Exception):
+    """A request would have to wait too long for a rate limit.
+
+    Parameters
+    ----------
+    retry_after : float
+        Seconds after which the request may be made.
+    """
+
+    def __init__(self, retry_after):
+        super().__init__(f"Rate limited, retry after {retry_after:.1f} s")
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    """Allow bursts of requests up to a limit while keeping an average rate.
+
+    Parameters
+    ----------
+    rate : float
+        The sustained number of requests per second.
+    burst : int
+        The number of requests that may be made at once after a quiet period.
+    """
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._paused_until = 0
+        self._waiting = 0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now):
+        self._tokens = min(
+            self.burst, self._tokens + (now - self._updated) * self.rate
+        )
+        self._updated = now
+
+    async def acquire(self, max_wait=None):
+        """Wait until a request may be made. Waiters are served in order.
+
+        If max_wait is given and the estimated wait, see `wait_time`, is
+        longer, `RateLimited` is raised instead of waiting.
+        """
+        if max_wait is not None:
+            wait = self.wait_time()
+            if wait > max_wait:
+                raise RateLimited(wait)
+        self._waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    now = time.monotonic()
+                    self._refill(now)
+                    wait = self._paused_until - now
+                    if wait <= 0 and self._tokens >= 1:
+                        self._tokens -= 1
+                        return
+                    await asyncio.sleep(max(wait, (1 - self._tokens) / self.rate))
+        finally:
+            self._waiting -= 1
+
+    def wait_time(self):
+        """Return the estimated seconds a new request would wait for its turn."""
+        now = time.monotonic()
+        self._refill(now)
+        missing = self._waiting + 1 - self._tokens
+        return max(self._paused_until - now, missing / self.rate, 0)
+
+    def pause(self, seconds):
+        """Make no requests for the given number of seconds."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def update(self, headers):
+        """Follow the X-Ratelimit-* headers of a Mattermost response."""
+        remaining = headers.get("X-Ratelimit-Remaining")
+        if remaining is None:
+            return
+        try:
+            remaining = float(remaining)
+            reset = float(headers.get("X-Ratelimit-Reset", 1))
+        except ValueError:
+            return
+        self._refill(time.monotonic())
+        self._tokens = min(self._tokens, remaining)
+        if remaining < 1:
+            self.pause(reset)
+
+
+def retry_after(response, default=1):
+    """Return the seconds to wait before retrying a rate limited request."""
+    for header in ("Retry-After", "X-Ratelimit-Reset"):
+        try:
+            return max(float(response.headers[header]), 0)
+        except (KeyError, ValueError):
+            continue
+    return default
+
+
+class SlidingWindow:
+    """Limit the total amount used per key within a moving time window.
+
+    Parameters
+    ----------
+    limit : float
+        The largest total amount per key within the window.
+    period : float
+        The length of the window in seconds.
+    """
+
+    def __init__(self, limit, period):
+        self.limit = limit
+        self.period = period
+        self._usage = {}
+
+    def _expire(self, key, now):
+        usage = self._usage.get(key)
+        while usage and usage[0][0] <= now - self.period:
+            usage.popleft()
+        if not usage:
+            self._usage.pop(key, None)
+        return usage or ()
+
+    def retry_after(self, key, amount=1):
+        """Return the seconds until amount may be used, 0 if it may be now."""
+        now = time.monotonic()
+        usage = self._expire(key, now)
+        used = sum(a for _, a in usage)
+        if used + amount <= self.limit:
+            return 0
+        if amount > self.limit:
+            return self.period
+        # Wait until enough of the oldest usage leaves the window
+        for timestamp, a in usage:
+            used -= a
+            if used + amount <= self.limit:
+                return timestamp + self.period - now
+        return self.period
+
+    def add(self, key, amount=1):
+        """Record that amount was used."""
+        now = time.monotonic()
+        self._expire(key, now)
+        self._usage.setdefault(key, deque()).append((now, amount))
+
+    def remove(self, key, amount=1):
+        """Take back amount of the latest usage, e.g. of a refused request."""
+        usage = self._usage.get(key)
+        while usage and amount > 0:
+            timestamp, used = usage.pop()
+            if used > amount:
+                usage.append((timestamp, used - amount))
+            amount -= used
+        if not usage:
+            self._usage.pop(key, None)
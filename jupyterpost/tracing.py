@@ -0,0 +1,101 @@
+"""Tracing of the requests to the service and of its Mattermost API calls.
+
+Spans are made with OpenTelemetry, an optional dependency of jupyterpost. If
+it is not installed, tracing does nothing. `configure` exports the spans to
+the console or to a file, otherwise any OpenTelemetry setup of the process is
+used.
+"""
+from contextlib import contextmanager, nullcontext
+
+try:
+    from opentelemetry import context, trace
+except ImportError:
+    context = trace = None
+
+
+def _tracer():
+    return trace.get_tracer("jupyterpost")
+
+
+@contextmanager
+def span(name, **attributes):
+    """Run the body in a new span that is a child of the current one.
+
+    Yields the span, or None if OpenTelemetry is not installed.
+    """
+    if trace is None:
+        yield None
+        return
+    with _tracer().start_as_current_span(name, attributes=attributes) as current:
+        yield current
+
+
+def start_span(name, **attributes):
+    """Start a span that is ended explicitly, or return None without tracing."""
+    if trace is None:
+        return None
+    return _tracer().start_span(name, attributes=attributes)
+
+
+def use_span(span):
+    """Make a span from `start_span` the current one in the body, not ending it."""
+    if span is None:
+        return nullcontext()
+    return trace.use_span(span, end_on_exit=False)
+
+
+def activate(span):
+    """Make a span the current one for the rest of the running task."""
+    if span is not None:
+        context.attach(trace.set_span_in_context(span))
+
+
+def end_span(span, status_code):
+    """End a span from `start_span` of a request answered with status_code."""
+    if span is None:
+        return
+    span.set_attribute("http.response.status_code", status_code)
+    if status_code >= 500:
+        span.set_status(trace.StatusCode.ERROR)
+    span.end()
+
+
+def configure(destination):
+    """Export spans to the console or to a file, one JSON object per line.
+
+    Parameters
+    ----------
+    destination : str
+        "console" for the standard output, or the path of the file to append
+        to.
+    """
+    try:
+        from opentelemetry.sdk.resources import Resource
+        from opentelemetry.sdk.trace import TracerProvider
+        from opentelemetry.sdk.trace.export import (
+            BatchSpanProcessor,
+            ConsoleSpanExporter,
+        )
+    except ImportError:
+        raise ImportError("Tracing requires opentelemetry-sdk") from None
+    if destination == "console":
+        exporter = ConsoleSpanExporter()
+    else:
+        exporter = ConsoleSpanExporter(
+            out=open(destination, "a"),
+            formatter=lambda span: span.to_json(indent=None) + "\n",
+        )
+    provider = TracerProvider(
+        resource=Resource.create({"service.name": "jupyterpost"})
+    )
+    # Spans are written in a thread, not to block the service
+    provider.add_span_processor(BatchSpanProcessor(exporter))
+    trace.set_tracer_provider(provider)
+
+
+def shutdown():
+    """Export the remaining spans, if `configure` was used."""
+    if trace is not None:
+        provider = trace.get_tracer_provider()
+        if hasattr(provider, "shutdown"):
+            provider.shutdown()
@@ -0,0 +1,71 @@
+"""Fixtures for the jupyterpost tests.
+
+The service handlers run in the test process and talk to the fake Mattermost
+of `jupyterpost.fake_mattermost`. Users are not checked with JupyterHub, the
+token is taken as the username, see `jupyterpost.loadtest`.
+"""
+from contextlib import asynccontextmanager
+
+import httpx
+import pytest
+
+from jupyterpost import fake_mattermost, loadtest
+
+# Rate limits are lifted, tests of them make their own limits. The URL is
+# replaced by the one of the fake Mattermost of every test.
+loadtest.configure_service("http://127.0.0.1:1/api/v4/")
+loadtest.use_token_auth()
+
+from jupyterpost import jupyterpost  # noqa: E402
+
+PREFIX = "/services/jupyterpost/"
+
+
+@pytest.fixture
+def mattermost():
+    """The fake Mattermost application, recording posts and files.
+
+    The caches of the service are emptied, so that it sees only this one.
+    """
+    jupyterpost._bot_id = None
+    jupyterpost.invalidate_team_id()
+    for cache in (
+        jupyterpost._channel_cache,
+        jupyterpost._user_cache,
+        jupyterpost._member_cache,
+        jupyterpost._direct_channel_cache,
+        jupyterpost._channel_rate_limits,
+        jupyterpost._idempotency_cache,
+    ):
+        cache.clear()
+    return fake_mattermost.make_app(record=True)
+
+
+@pytest.fixture
+def service(mattermost, monkeypatch):
+    """Serve the service handlers within a test coroutine.
+
+    Use as ``async with service(**settings) as client``, where settings are
+    passed to `jupyterpost.make_app` and client is an httpx.AsyncClient
+    for the service URL, authenticated as the user "alice".
+    """
+
+    @asynccontextmanager
+    async def serve(**settings):
+        fake, url = loadtest.listen(mattermost)
+        monkeypatch.setenv("MATTERMOST_URL", url + "/api/v4/")
+        server, url = loadtest.listen(jupyterpost.make_app(PREFIX, **settings))
+        jupyterpost.open_mm_client()
+        try:
+            async with httpx.AsyncClient(
+                base_url=url + PREFIX, headers={"Authorization": "token alice"}
+            ) as client:
+                yield client
+        finally:
+            server.stop()
+            await server.close_all_connections()
+            await jupyterpost.close_mm_client()
+            fake.stop()
+            await fake.close_all_connections()
+
+    return serve
@@ -0,0 +1,46 @@
+import pytest
+
+from jupyterpost import cache
+from jupyterpost.cache import MISSING, TTLCache
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Control the time seen by the cache, returns a list holding the time."""
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_expiry(clock):
+    entries = TTLCache(maxsize=10, ttl=60)
+    entries.set("a", 1)
+    entries.set("b", 2, ttl=10)
+    clock[0] += 30
+    assert entries.get("a") == 1
+    assert entries.get("b") is MISSING
+    clock[0] += 31
+    assert entries.get("a") is MISSING
+    assert len(entries) == 0
+
+
+def test_eviction_of_least_recently_used(clock):
+    entries = TTLCache(maxsize=2, ttl=60)
+    entries.set("a", 1)
+    entries.set("b", 2)
+    entries.get("a")
+    entries.set("c", 3)
+    assert entries.get("b") is MISSING
+    assert entries.get("a") == 1
+    assert entries.get("c") == 3
+
+
+def test_stored_none_and_counts(clock):
+    entries = TTLCache()
+    entries.set("gone", None)
+    assert entries.get("gone") is None
+    assert entries.get("other", "default") == "default"
+    assert (entries.hits, entries.misses) == (1, 1)
+    entries.pop("gone")
+    entries.pop("gone")
+    assert entries.get("gone") is MISSING
@@ -0,0 +1,228 @@
+from base64 import b64encode
+from io import BytesIO
+import json
+import os
+import sys
+
+import httpx
+import pytest
+
+import jupyterpost
+from jupyterpost import client
+from jupyterpost.client import post_in_background, post_many
+
+SERVICE_URL = "http://jupyterpost.invalid/services/jupyterpost/"
+SERVICE = dict(service_url=SERVICE_URL)
+
+
+class FakeService:
+    """Answer the requests of the client and record them.
+
+    ``answers`` holds responses or exceptions for the next requests, the
+    others are answered with a post id.
+    """
+
+    def __init__(self):
+        self.requests = []
+        self.answers = []
+
+    def __call__(self, request):
+        self.requests.append(request)
+        if self.answers:
+            answer = self.answers.pop(0)
+            if isinstance(answer, Exception):
+                raise answer
+            return answer
+        return httpx.Response(200, json={"post_id": f"post-{len(self.requests)}"})
+
+
+@pytest.fixture
+def service(monkeypatch):
+    """A fake service that the client functions post to."""
+    monkeypatch.setenv("JPY_API_TOKEN", "token")
+    fake = FakeService()
+    monkeypatch.setattr(
+        client,
+        "_get_client",
+        lambda token: httpx.Client(transport=httpx.MockTransport(fake)),
+    )
+    return fake
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Needs os.fork")
+def test_post_in_background_after_fork(service):
+    # Start the worker thread in the parent
+    assert post_in_background("Parent", "town-square", **SERVICE).result(5)
+    pid = os.fork()
+    if pid == 0:
+        try:
+            post_in_background("Child", "town-square", **SERVICE).result(5)
+        finally:
+            os._exit(0 if len(service.requests) == 2 else 1)
+    assert os.waitstatus_to_exitcode(os.waitpid(pid, 0)[1]) == 0
+
+
+def test_post_many(service):
+    posts = [
+        {"message": "Plot", "channel": "town-square", "attachment": b"png"},
+        {"message": "Data", "channel": "@bob", "attachment": [("data.csv", b"")]},
+    ]
+    results = [{"post_id": "post-1"}, {"error": "@bob does not exist"}]
+    service.answers.append(httpx.Response(200, json=results))
+    assert post_many(posts, **SERVICE) == results
+    (request,) = service.requests
+    assert request.url.path == "/services/jupyterpost/batch"
+    assert json.loads(request.content) == [
+        {
+            "message": "Plot",
+            "channel": "town-square",
+            "attachments": [{"filename": "upload.png", "data": "cG5n"}],
+        },
+        # Empty files are left out
+        {"message": "Data", "channel": "@bob", "attachments": []},
+    ]
+
+
+def test_post_many_resends_rate_limited(service, monkeypatch):
+    sleeps = []
+    monkeypatch.setattr(client.time, "sleep", sleeps.append)
+    posts = [{"message": str(i), "channel": "town-square"} for i in range(3)]
+    limited = [{"error": "Rate limited", "retry_after": s} for s in (2, 3, 1)]
+    service.answers += [
+        httpx.Response(200, json=[{"post_id": "post-1"}, *limited[:2]]),
+        httpx.Response(200, json=[{"post_id": "post-2"}, limited[2]]),
+        httpx.Response(200, json=[{"post_id": "post-3"}]),
+    ]
+    results = post_many(posts, **SERVICE)
+    assert results == [{"post_id": f"post-{i}"} for i in (1, 2, 3)]
+    # Only the refused posts are sent again, after the longest wait
+    sent = [[p["message"] for p in json.loads(r.content)] for r in service.requests]
+    assert sent == [["0", "1", "2"], ["1", "2"], ["2"]]
+    assert sleeps == [3, 1]
+    # Every batch is a new request for the service
+    keys = {r.headers["Idempotency-Key"] for r in service.requests}
+    assert len(keys) == 3
+
+
+@pytest.fixture
+def sleeps(monkeypatch):
+    """Record the waits between retries instead of waiting, without jitter."""
+    sleeps = []
+    monkeypatch.setattr(client.random, "uniform", lambda a, b: a)
+    monkeypatch.setattr(client.time, "sleep", sleeps.append)
+    return sleeps
+
+
+def test_retry_wait(sleeps):
+    assert client._retry_wait(0) == 0.5
+    assert client._retry_wait(2) == 2
+    assert client._retry_wait(1, httpx.Response(503)) == 1
+    assert client._retry_wait(0, httpx.Response(429, headers={"Retry-After": "3"})) == 3
+    assert client._retry_wait(1, httpx.Response(429)) == 1
+    # Waits that are too long and errors that would happen again are not retried
+    headers = {"Retry-After": str(client.MAX_RETRY_WAIT + 1)}
+    too_long = httpx.Response(429, headers=headers)
+    assert client._retry_wait(0, too_long) is None
+    assert client._retry_wait(0, httpx.Response(400)) is None
+
+
+def test_retries(service, sleeps):
+    service.answers += [
+        httpx.ConnectError("down"),
+        httpx.Response(503),
+        httpx.Response(429, headers={"Retry-After": "3"}),
+    ]
+    assert jupyterpost.post("Done", "town-square", **SERVICE) == {"post_id": "post-4"}
+    assert sleeps == [0.5, 1, 3]
+    # Every attempt is recognized by the service as the same post
+    assert len({r.headers["Idempotency-Key"] for r in service.requests}) == 1
+
+
+def test_retries_give_up(service, sleeps):
+    service.answers += [httpx.Response(503, text="Mattermost error 503")] * 2
+    with pytest.raises(ValueError, match="Mattermost error 503"):
+        jupyterpost.post("Done", "town-square", retries=1, **SERVICE)
+    service.answers += [httpx.ReadTimeout("slow")] * 2
+    with pytest.raises(httpx.ReadTimeout):
+        jupyterpost.post("Done", "town-square", retries=1, **SERVICE)
+    assert sleeps == [0.5, 0.5]
+    assert len(service.requests) == 4
+
+
+@pytest.fixture
+def shell():
+    """An IPython shell with the magics loaded."""
+    from IPython.core.interactiveshell import InteractiveShell
+
+    shell = InteractiveShell.instance()
+    jupyterpost.load_ipython_extension(shell)
+    return shell
+
+
+def posted_files(request):
+    """Return the number of attachments of a post request."""
+    return request.content.count(b'name="file')
+
+
+@pytest.mark.parametrize("background", [False, True])
+def test_magic_splits_attachments(service, shell, background):
+    shell.user_ns["PNG"] = b"\x89PNG\r\n\x1a\n" + bytes(100)
+    cell = "for _ in range(23):\n    display(Image(PNG))"
+    shell.run_cell("from IPython.display import Image, display")
+    line = f"{'-b ' if background else ''}town-square 23 plots --url {SERVICE_URL}"
+    shell.run_cell_magic("post", line, cell)
+    if background:
+        # Wait for the posts sent by the worker
+        client._executor.submit(int).result(5)
+    assert [posted_files(request) for request in service.requests] == [10, 10, 3]
+    assert b"23 plots" in service.requests[0].content
+    assert b"23 plots" not in service.requests[1].content
+
+
+def test_line_magic(service, shell):
+    shell.run_line_magic("post", f"@bob Training done --url {SERVICE_URL}")
+    (request,) = service.requests
+    assert request.content == b"message=Training+done&channel=%40bob"
+
+
+def test_base64_images_are_not_decoded(service):
+    image = b64encode(b"\x89PNG\r\n\x1a\n").decode()
+    jupyterpost.post("Plot", "town-square", [image, b"raw"], **SERVICE)
+    (request,) = service.requests
+    assert b'name="file_base64"' in request.content
+    assert image.encode() in request.content
+    assert b'name="file"; filename="upload.png"' in request.content
+
+
+def test_is_image():
+    assert client._is_image(b"\x89PNG\r\n\x1a\n...")
+    assert client._is_image(b"\xff\xd8\xff\xe0...")
+    assert client._is_image(b"RIFF\x00\x00\x00\x00WEBPVP8 ")
+    assert not client._is_image(b"RIFF\x00\x00\x00\x00WAVEfmt ")
+    assert not client._is_image(b"a,b\n1,2\n")
+
+
+def test_compress_only_images():
+    Image = pytest.importorskip("PIL.Image")
+    data = BytesIO()
+    Image.new("RGB", (200, 100)).save(data, format="png")
+    png = data.getvalue()
+    files = client._as_files(
+        [("plot.png", png), ("data.csv", b"a,b\n"), b64encode(png).decode()],
+        compress=dict(max_size=50, format="webp"),
+    )
+    assert [name for name, _ in files] == ["plot.webp", "data.csv", "upload.webp"]
+    assert files[1][1] == b"a,b\n"
+    assert Image.open(BytesIO(files[2][1])).size == (50, 25)
+
+
+def test_magic_posts_jpeg_and_svg(service, shell, monkeypatch):
+    # Without cairosvg svg images are attached as they are
+    monkeypatch.setitem(sys.modules, "cairosvg", None)
+    shell.user_ns["JPEG"] = b"\xff\xd8\xff\xe0" + bytes(100)
+    cell = "display(Image(JPEG, format='jpeg'), SVG('<svg></svg>'))"
+    shell.run_cell("from IPython.display import Image, SVG, display")
+    shell.run_cell_magic("post", f"town-square --url {SERVICE_URL}", cell)
+    (request,) = service.requests
+    assert b'filename="upload.jpg"' in request.content
+    assert b'filename="upload.svg"' in request.content
@@ -0,0 +1,85 @@
+import asyncio
+import logging
+
+from jupyterpost.coalesce import Coalescer
+
+
+def collect(window, max_files=10, fail=False):
+    """Return a coalescer with a short window and the list of what it sent."""
+    sent = []
+
+    async def send(key, messages, files):
+        if fail:
+            raise RuntimeError("Mattermost is down")
+        sent.append((key, messages, files))
+
+    return Coalescer(window, send, max_files=max_files), sent
+
+
+def test_merges_within_window():
+    async def run():
+        coalescer, sent = collect(0.05)
+        coalescer.add("a", "first", [("a.png", b"1")])
+        coalescer.add("b", "other")
+        coalescer.add("a", "second", [("b.png", b"2")])
+        await asyncio.sleep(0.1)
+        # A new window starts after the end of the first one
+        coalescer.add("a", "third")
+        await asyncio.sleep(0.1)
+        return sent
+
+    assert asyncio.run(run()) == [
+        ("a", ["first", "second"], [("a.png", b"1"), ("b.png", b"2")]),
+        ("b", ["other"], []),
+        ("a", ["third"], []),
+    ]
+
+
+def test_too_many_files_end_window():
+    async def run():
+        coalescer, sent = collect(60, max_files=3)
+        coalescer.add("a", "first", [("a.png", b"1")] * 2)
+        coalescer.add("a", "second", [("b.png", b"2")] * 2)
+        await asyncio.sleep(0)
+        # Sent without waiting for the window
+        assert sent == [("a", ["first"], [("a.png", b"1")] * 2)]
+        await coalescer.flush_all()
+        return sent
+
+    assert asyncio.run(run())[1] == ("a", ["second"], [("b.png", b"2")] * 2)
+
+
+def test_flush_all():
+    async def run():
+        coalescer, sent = collect(60)
+        coalescer.add("a", "first")
+        coalescer.add("b", "other")
+        await coalescer.flush_all()
+        return sent
+
+    assert [key for key, _, _ in asyncio.run(run())] == ["a", "b"]
+
+
+def test_send_errors_are_logged(caplog):
+    async def run():
+        coalescer, _ = collect(60, fail=True)
+        coalescer.add("a", "first")
+        coalescer.add("a", "second")
+        await coalescer.flush_all()
+
+    with caplog.at_level(logging.ERROR, logger="jupyterpost"):
+        asyncio.run(run())
+    assert "Posting 2 merged messages failed" in caplog.text
+
+
+def test_window_is_not_extended():
+    async def run():
+        coalescer, sent = collect(0.05)
+        coalescer.add("a", "first")
+        await asyncio.sleep(0.03)
+        coalescer.add("a", "second")
+        await asyncio.sleep(0.03)
+        return sent
+
+    # The window starts with the first message, later ones do not restart it
+    assert asyncio.run(run()) == [("a", ["first", "second"], [])]
@@ -0,0 +1,80 @@
+from collections import OrderedDict
+from io import BytesIO
+import sys
+from types import SimpleNamespace
+
+import pytest
+
+from jupyterpost import images
+from jupyterpost.images import transcode
+
+
+@pytest.fixture
+def image():
+    """Return a function making images with pillow."""
+    Image = pytest.importorskip("PIL.Image")
+
+    def make(mode="RGB", size=(200, 100), format="png", **options):
+        data = BytesIO()
+        Image.new(mode, size, "red").save(data, format=format, **options)
+        return data.getvalue()
+
+    make.open = lambda data: Image.open(BytesIO(data))
+    return make
+
+
+def test_downscale(image):
+    data, extension = transcode(image(), max_size=50, format="webp")
+    assert extension == "webp"
+    # The aspect ratio is kept
+    assert image.open(data).size == (50, 25)
+
+
+def test_jpeg_without_transparency(image):
+    data, extension = transcode(image("RGBA"), format="jpeg", quality=50)
+    assert extension == "jpg"
+    assert image.open(data).mode == "RGB"
+
+
+def test_png_that_cannot_be_compressed_is_kept(image):
+    original = image(optimize=True)
+    assert transcode(original) == (original, "png")
+
+
+def test_unsupported_format(image):
+    with pytest.raises(ValueError):
+        transcode(image(), format="gif")
+
+
+@pytest.fixture
+def cairosvg(monkeypatch):
+    """A stand-in for cairosvg recording the svg images it renders."""
+    rendered = []
+
+    def svg2png(bytestring):
+        rendered.append(bytestring)
+        return b"png of " + bytestring
+
+    monkeypatch.setitem(sys.modules, "cairosvg", SimpleNamespace(svg2png=svg2png))
+    monkeypatch.setattr(images, "_svg_cache", OrderedDict())
+    return rendered
+
+
+def test_svg_is_rendered_once(cairosvg):
+    assert images.rasterize_svg("<svg/>") == b"png of <svg/>"
+    assert images.rasterize_svg(b"<svg/>") == b"png of <svg/>"
+    assert cairosvg == [b"<svg/>"]
+
+
+def test_svg_cache_evicts_least_recently_used(cairosvg, monkeypatch):
+    monkeypatch.setattr(images, "SVG_CACHE_SIZE", 2)
+    for svg in ["<a/>", "<b/>", "<a/>", "<c/>", "<a/>", "<b/>"]:
+        images.rasterize_svg(svg)
+    assert cairosvg == [b"<a/>", b"<b/>", b"<c/>", b"<b/>"]
+
+
+def test_svg_without_cairosvg(monkeypatch):
+    monkeypatch.setitem(sys.modules, "cairosvg", None)
+    monkeypatch.setattr(images, "_svg_cache", OrderedDict())
+    with pytest.raises(ImportError, match="cairosvg"):
+        images.rasterize_svg("<svg/>")
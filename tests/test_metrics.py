@@ -0,0 +1,42 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+# Run in a fresh interpreter, prometheus_client only uses the directory if it
+# is set when it is imported.
+MULTIPROCESS = """
+import os
+
+from jupyterpost import loadtest
+
+loadtest.configure_service("http://127.0.0.1:1/api/v4/")
+
+from jupyterpost import jupyterpost, metrics
+
+metrics.ERRORS.labels("service", "500").inc()
+pid = os.fork()
+if pid == 0:
+    metrics.ERRORS.labels("service", "500").inc()
+    os._exit(0)
+os.waitpid(pid, 0)
+metrics.register_cache_stats(jupyterpost.cache_stats)
+print(metrics.latest()[0].decode())
+"""
+
+
+@pytest.mark.skipif(not hasattr(os, "fork"), reason="Needs os.fork")
+def test_processes_add_up(tmp_path):
+    env = {**os.environ, "PROMETHEUS_MULTIPROC_DIR": str(tmp_path / "metrics")}
+    output = subprocess.run(
+        [sys.executable, "-c", MULTIPROCESS],
+        env=env,
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout
+    assert 'jupyterpost_errors_total{code="500",origin="service"} 2.0' in output
+    assert 'jupyterpost_cache_size{cache="channel",pid="' in output
+    # JupyterHub writes its metrics to the same directory
+    assert "jupyterhub_" not in output
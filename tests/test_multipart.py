@@ -0,0 +1,105 @@
+import asyncio
+from base64 import b64encode
+import os
+
+import pytest
+
+from jupyterpost.multipart import Base64Decoder, MultipartParser, get_boundary
+
+BOUNDARY = b"xYzZy"
+
+
+def multipart(*parts):
+    """Encode parts given as ``(name, filename, data)`` as a multipart body."""
+    body = b"preamble\r\n"
+    for name, filename, data in parts:
+        disposition = f'form-data; name="{name}"'
+        if filename is not None:
+            disposition += f'; filename="{filename}"'
+        body += b"--" + BOUNDARY + b"\r\n"
+        body += f"Content-Disposition: {disposition}\r\n\r\n".encode() + data + b"\r\n"
+    return body + b"--" + BOUNDARY + b"--\r\nepilogue"
+
+
+def parse(body, chunk_size=None):
+    """Feed body to a parser in chunks, return the parts and whether it is done."""
+    parts = []
+    parser = MultipartParser(
+        BOUNDARY,
+        lambda name, filename: parts.append([name, filename, b"", False]),
+        lambda data: parts[-1].__setitem__(2, parts[-1][2] + data),
+        lambda: parts[-1].__setitem__(3, True),
+    )
+    chunk_size = chunk_size or len(body)
+
+    async def feed():
+        for start in range(0, len(body), chunk_size):
+            await parser.feed(body[start : start + chunk_size])
+
+    asyncio.run(feed())
+    return [tuple(part) for part in parts], parser.done
+
+
+PARTS = [
+    ("channel", None, b"town-square"),
+    ("message", None, b"Line\r\nwith --xYzZ almost a boundary"),
+    ("file", "plot.png", os.urandom(3000)),
+    ("file", "empty.png", b""),
+]
+
+
+def test_get_boundary():
+    assert get_boundary("multipart/form-data; boundary=abc") == b"abc"
+    assert get_boundary('multipart/form-data; boundary="a b"; x=y') == b"a b"
+    assert get_boundary("application/x-www-form-urlencoded") is None
+    with pytest.raises(ValueError):
+        get_boundary("multipart/form-data")
+
+
+@pytest.mark.parametrize("chunk_size", [None, 1, 2, 3, 7, 64, 1000])
+def test_parts_split_across_chunks(chunk_size):
+    parts, done = parse(multipart(*PARTS), chunk_size)
+    assert done
+    assert parts == [(*part, True) for part in PARTS]
+
+
+def test_incomplete_body():
+    body = multipart(*PARTS)
+    parts, done = parse(body[: len(body) // 2])
+    assert not done
+    assert not parts[-1][3]
+
+
+@pytest.mark.parametrize(
+    "body",
+    [
+        b"--" + BOUNDARY + b"XX",
+        b"--" + BOUNDARY + b'\r\nContent-Disposition: form-data; filename="a"\r\n\r\n',
+    ],
+)
+def test_malformed_body(body):
+    with pytest.raises(ValueError):
+        parse(body)
+
+
+@pytest.mark.parametrize("piece", [1, 2, 3, 5, 76])
+def test_base64_decoder(piece):
+    data = os.urandom(1000)
+    encoded = b64encode(data)
+    # Line breaks, as in encoded mails, are ignored
+    encoded = b"\r\n".join(encoded[i : i + 76] for i in range(0, len(encoded), 76))
+    decoder = Base64Decoder()
+    decoded = b"".join(
+        decoder.decode(encoded[i : i + piece]) for i in range(0, len(encoded), piece)
+    )
+    decoder.finish()
+    assert decoded == data
+
+
+def test_base64_decoder_errors():
+    with pytest.raises(ValueError):
+        Base64Decoder().decode(b"!!!!")
+    decoder = Base64Decoder()
+    decoder.decode(b"QUJD" + b"QQ")
+    with pytest.raises(ValueError):
+        decoder.finish()
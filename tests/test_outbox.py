@@ -0,0 +1,116 @@
+import asyncio
+
+import httpx
+
+from jupyterpost.outbox import Outbox
+
+
+def run_until(outbox, done, timeout=5):
+    """Run the outbox until done() is true."""
+
+    async def finished():
+        while not done():
+            await asyncio.sleep(0.01)
+
+    async def run():
+        worker = asyncio.ensure_future(outbox.run())
+        try:
+            await asyncio.wait_for(finished(), timeout)
+        finally:
+            worker.cancel()
+
+    asyncio.run(run())
+
+
+def run_until_sent(outbox, count):
+    """Run the outbox until count posts are sent or failed."""
+    query = "SELECT COUNT(*) FROM posts WHERE status IN ('sent', 'failed')"
+    run_until(outbox, lambda: outbox._db.execute(query).fetchone()[0] >= count)
+
+
+def http_error(status):
+    request = httpx.Request("POST", "http://mattermost.invalid/api/v4/posts")
+    response = httpx.Response(status, request=request)
+    return httpx.HTTPStatusError(f"Error {status}", request=request, response=response)
+
+
+def test_retries_keep_channel_order(tmp_path):
+    sent = []
+    pending_post_ids = {}
+    failures = {"first": [httpx.ConnectError("down"), http_error(503)]}
+
+    async def send(message, channel, files, pending_post_id):
+        pending_post_ids.setdefault(message, set()).add(pending_post_id)
+        if failures.get(message):
+            raise failures[message].pop(0)
+        sent.append((channel, message, files))
+        return {"id": f"post-{len(sent)}"}
+
+    outbox = Outbox(tmp_path / "queue.db", send, backoff=0.01)
+    first = outbox.enqueue("alice", "first", "town-square", [("a.png", b"png")])
+    outbox.enqueue("alice", "second", "town-square")
+    outbox.enqueue("bob", "other", "off-topic")
+    run_until_sent(outbox, 3)
+    # The other channel is not held up by the failing post
+    assert sent[0] == ("off-topic", "other", [])
+    assert sent[1:] == [
+        ("town-square", "first", [("a.png", b"png")]),
+        ("town-square", "second", []),
+    ]
+    status = outbox.status(first, "alice")
+    assert status["status"] == "sent"
+    assert status["attempts"] == 2
+    assert status["post_id"] == "post-2"
+    assert outbox.status(first, "bob") is None
+    assert outbox.depth() == 0
+    # Retries are recognized by Mattermost, different posts are not
+    assert len(pending_post_ids["first"]) == 1
+    assert len(set.union(*pending_post_ids.values())) == 3
+
+
+def test_gives_up(tmp_path):
+    attempts = []
+
+    async def send(message, channel, files, pending_post_id):
+        attempts.append(message)
+        if message == "refused":
+            raise http_error(400)
+        raise httpx.ConnectError("down")
+
+    outbox = Outbox(tmp_path / "queue.db", send, max_attempts=3, backoff=0.01)
+    refused = outbox.enqueue("alice", "refused", "town-square")
+    unreachable = outbox.enqueue("alice", "unreachable", "off-topic")
+    run_until_sent(outbox, 2)
+    # Errors that would happen again are not retried
+    assert outbox.status(refused)["status"] == "failed"
+    assert outbox.status(refused)["attempts"] == 1
+    assert outbox.status(unreachable)["status"] == "failed"
+    assert attempts.count("unreachable") == 3
+
+
+def test_survives_restart(tmp_path):
+    pending_post_ids = []
+
+    async def hang(message, channel, files, pending_post_id):
+        pending_post_ids.append(pending_post_id)
+        await asyncio.Event().wait()
+
+    outbox = Outbox(tmp_path / "queue.db", hang)
+    post = outbox.enqueue("alice", "message", "town-square")
+    # The service stops while the post is being sent
+    run_until(outbox, lambda: pending_post_ids)
+    assert outbox.status(post)["status"] == "sending"
+    outbox.close()
+    sent = []
+
+    async def send(message, channel, files, pending_post_id):
+        sent.append(message)
+        pending_post_ids.append(pending_post_id)
+        return {"id": "post"}
+
+    outbox = Outbox(tmp_path / "queue.db", send)
+    run_until_sent(outbox, 1)
+    # Sent again, and ignored by Mattermost if the first attempt created it
+    assert sent == ["message"]
+    assert pending_post_ids[0] == pending_post_ids[1]
+    assert outbox.status(post)["status"] == "sent"
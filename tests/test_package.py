@@ -0,0 +1,11 @@
+import jupyterpost
+
+
+def test_dir_lists_names_once():
+    names = dir(jupyterpost)
+    assert len(names) == len(set(names))
+    assert {"configure_jupyterhub", "post", "__version__"} <= set(names)
+
+
+def test_service_names_are_lazy():
+    assert jupyterpost.hub_post_message.__module__ == "jupyterpost.jupyterpost"
@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from jupyterpost import ratelimit
+from jupyterpost.ratelimit import RateLimited, SlidingWindow, TokenBucket
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Control the time seen by the limits, returns a list holding the time."""
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "monotonic", lambda: now[0])
+    return now
+
+
+def test_sliding_window(clock):
+    window = SlidingWindow(limit=3, period=60)
+    assert window.retry_after("alice", 3) == 0
+    window.add("alice", 2)
+    clock[0] += 10
+    window.add("alice")
+    assert window.retry_after("alice") == 50
+    # Enough leaves the window once the first usage expires
+    assert window.retry_after("alice", 2) == 50
+    assert window.retry_after("alice", 3) == 60
+    assert window.retry_after("bob", 3) == 0
+    clock[0] += 50
+    assert window.retry_after("alice", 2) == 0
+    assert window.retry_after("alice", 3) == 10
+
+
+def test_sliding_window_larger_than_limit(clock):
+    window = SlidingWindow(limit=3, period=60)
+    assert window.retry_after("alice", 4) == 60
+
+
+def test_sliding_window_remove(clock):
+    window = SlidingWindow(limit=3, period=60)
+    window.add("alice", 2)
+    clock[0] += 10
+    window.add("alice", 1)
+    # The latest usage is taken back first
+    window.remove("alice", 2)
+    assert window.retry_after("alice", 2) == 0
+    assert window.retry_after("alice", 3) == 50
+    window.remove("alice", 5)
+    assert window.retry_after("alice", 3) == 0
+    window.remove("bob")
+
+
+def test_token_bucket_wait_time(clock):
+    bucket = TokenBucket(rate=2, burst=2)
+
+    async def acquire(n):
+        for _ in range(n):
+            await bucket.acquire(max_wait=0)
+
+    asyncio.run(acquire(2))
+    assert bucket.wait_time() == 0.5
+    with pytest.raises(RateLimited) as error:
+        asyncio.run(acquire(1))
+    assert error.value.retry_after == 0.5
+    clock[0] += 1
+    assert bucket.wait_time() == 0
+    bucket.pause(3)
+    assert bucket.wait_time() == 3
+
+
+def test_token_bucket_follows_headers(clock):
+    bucket = TokenBucket(rate=2, burst=5)
+    bucket.update({"X-Ratelimit-Remaining": "1"})
+    assert bucket.wait_time() == 0
+    bucket.update({"X-Ratelimit-Remaining": "0", "X-Ratelimit-Reset": "4"})
+    assert bucket.wait_time() == 4
+    # Responses without the headers change nothing
+    bucket.update({})
+    assert bucket.wait_time() == 4
+
+
+def test_token_bucket_paces():
+    bucket = TokenBucket(rate=100, burst=1)
+
+    async def acquire(n):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        await asyncio.gather(*(bucket.acquire() for _ in range(n)))
+        return loop.time() - start
+
+    assert asyncio.run(acquire(6)) >= 0.045
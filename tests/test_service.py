@@ -0,0 +1,415 @@
+import asyncio
+from base64 import b64encode
+from io import BytesIO
+import os
+import sys
+import uuid
+
+import httpx
+import pytest
+
+from jupyterpost import jupyterpost
+from jupyterpost.ratelimit import SlidingWindow
+
+from test_multipart import BOUNDARY, multipart
+
+PNG = b"\x89PNG\r\n\x1a\n" + os.urandom(100_000)
+
+
+def post(service, *requests, concurrent=False, **settings):
+    """Make requests to a service and return the responses.
+
+    Every request is a dict of arguments of httpx.AsyncClient.post. They are
+    made one after another, or all at once if concurrent is True.
+    """
+
+    async def run():
+        async with service(**settings) as client:
+            calls = [client.post(r.pop("url", ""), **r) for r in requests]
+            if concurrent:
+                return await asyncio.gather(*calls)
+            return [await call for call in calls]
+
+    return asyncio.run(run())
+
+
+def message(text="Training done", channel="town-square", key=None, **kwargs):
+    """Return the arguments of a request posting a message."""
+    headers = {"Idempotency-Key": key} if key else {}
+    return dict(data={"message": text, "channel": channel}, headers=headers, **kwargs)
+
+
+def test_post(service, mattermost):
+    (response,) = post(service, message())
+    assert response.status_code == 200
+    (posted,) = mattermost.settings["posts"]
+    assert response.json() == {"post_id": posted["id"]}
+    assert posted["channel_id"].startswith("channel-")
+    assert posted["message"] == "*@alice (via jupyterpost)*: Training done"
+
+
+def test_direct_message(service, mattermost):
+    (response,) = post(service, message(channel="@bob"))
+    assert response.status_code == 200
+    assert mattermost.settings["posts"][0]["channel_id"].startswith("direct-")
+
+
+def test_unauthenticated(service, mattermost):
+    request = message()
+    request["headers"]["Authorization"] = ""
+    (response,) = post(service, request)
+    assert response.status_code == 403
+    assert not mattermost.settings["posts"]
+
+
+def test_streamed_attachments(service, mattermost):
+    files = [
+        ("file", ("plot.png", PNG)),
+        ("file", ("../../data.csv", b"a,b\n1,2\n")),
+    ]
+    (response,) = post(service, message(files=files))
+    assert response.status_code == 200
+    # Uploaded concurrently while the request arrives
+    assert sorted(mattermost.settings["files"]) == [
+        ("data.csv", b"a,b\n1,2\n"),
+        ("plot.png", PNG),
+    ]
+    assert len(mattermost.settings["posts"][0]["file_ids"]) == 2
+
+
+def test_base64_attachments(service, mattermost):
+    files = [
+        ("file_base64", ("plot.png", b64encode(PNG))),
+        ("file", ("other.png", PNG)),
+    ]
+    (response,) = post(service, message(files=files))
+    assert response.status_code == 200
+    assert sorted(mattermost.settings["files"]) == [
+        ("other.png", PNG),
+        ("plot.png", PNG),
+    ]
+
+
+@pytest.mark.parametrize("data", [b"!!!!", b"QUJDRA"], ids=["invalid", "truncated"])
+def test_invalid_base64(service, mattermost, data):
+    (response,) = post(service, message(files=[("file_base64", ("a.png", data))]))
+    assert response.status_code == 400
+    assert not mattermost.settings["posts"]
+
+
+@pytest.mark.parametrize(
+    "files, data",
+    [
+        ([("file", ("plot.png", PNG))] * 11, None),
+        ([("file", ("plot.png", PNG))], {"message": "x" * 2**21}),
+        ([], {"message": "No channel"}),
+    ],
+    ids=["attachments", "field", "channel"],
+)
+def test_invalid_body(service, mattermost, files, data):
+    request = message(files=files)
+    if data is not None:
+        request["data"] = data
+    (response,) = post(service, request)
+    # Answered instead of dropping the connection
+    assert response.status_code == 400
+    assert not mattermost.settings["posts"]
+
+
+@pytest.mark.parametrize("body", [b"--bXX", b"--b\r\n\r\n"])
+def test_malformed_multipart(service, mattermost, body):
+    headers = {"Content-Type": "multipart/form-data; boundary=b"}
+    (response,) = post(service, dict(content=body, headers=headers))
+    assert response.status_code == 400
+    assert not mattermost.settings["posts"]
+
+
+def test_unknown_channel(service, mattermost):
+    mattermost.settings["missing"].add("nowhere")
+    (response,) = post(service, message(channel="nowhere"))
+    assert response.status_code == 400
+    assert "does not exist" in response.text
+
+
+def test_channels_are_cached(service, mattermost):
+    stats = mattermost.settings["stats"]
+    mattermost.settings["missing"].add("nowhere")
+    post(service, message(), message(channel="nowhere"))
+    requests = stats["requests"]
+    responses = post(service, message(), message(channel="nowhere"))
+    assert [r.status_code for r in responses] == [200, 400]
+    # Both channels are remembered, only the post itself is sent
+    assert stats["requests"] == requests + 1
+
+
+def test_repeated_request(service, mattermost):
+    key = uuid.uuid4().hex
+    first, second = post(
+        service, message(key=key), message(key=key, files=[("file", ("a.png", PNG))])
+    )
+    (posted,) = mattermost.settings["posts"]
+    assert first.json() == second.json() == {"post_id": posted["id"]}
+    # The body of a repeated request is not used
+    assert not mattermost.settings["files"]
+
+
+def test_concurrent_repeated_request(service, mattermost):
+    mattermost.settings["latency"] = 0.2
+    key = uuid.uuid4().hex
+    responses = post(service, message(key=key), message(key=key), concurrent=True)
+    (posted,) = mattermost.settings["posts"]
+    assert [r.json() for r in responses] == [{"post_id": posted["id"]}] * 2
+
+
+def test_failed_request_is_repeated(service, mattermost):
+    key = uuid.uuid4().hex
+    mattermost.settings["post_faults"].append(503)
+    first, second = post(service, message(key=key), message(key=key))
+    assert first.status_code == 500
+    (posted,) = mattermost.settings["posts"]
+    assert second.json() == {"post_id": posted["id"]}
+
+
+def test_lost_answer_is_not_posted_twice(service, mattermost):
+    key = uuid.uuid4().hex
+    mattermost.settings["post_faults"].append("lose")
+    first, second = post(service, message(key=key), message(key=key))
+    assert first.status_code == 500
+    # Mattermost recognizes the pending_post_id of the repeated post
+    (posted,) = mattermost.settings["posts"]
+    assert second.json() == {"post_id": posted["id"]}
+    assert mattermost.settings["stats"]["repeated posts"] == 1
+
+
+def test_keys_are_per_user(service, mattermost):
+    key = uuid.uuid4().hex
+    other_user = message(key=key)
+    other_user["headers"]["Authorization"] = "token bob"
+    post(service, message(key=key), other_user)
+    assert len(mattermost.settings["posts"]) == 2
+
+
+def test_batch(service, mattermost):
+    mattermost.settings["missing"].add("nowhere")
+    mattermost.settings["post_faults"] += ["drop", 503]
+    attachment = b64encode(PNG).decode()
+    batch = [
+        {"message": "dropped", "channel": "town-square"},
+        {"message": "failed", "channel": "town-square"},
+        {"message": "posted", "channel": "town-square", "attachments": [attachment]},
+        {"message": "lost", "channel": "nowhere"},
+    ]
+    (response,) = post(service, dict(url="batch", json=batch))
+    assert response.status_code == 200
+    (posted,) = mattermost.settings["posts"]
+    assert response.json() == [
+        {"error": "Could not reach Mattermost: RemoteProtocolError"},
+        {"error": "Mattermost error 503"},
+        {"post_id": posted["id"]},
+        {"error": "nowhere does not exist or is private"},
+    ]
+    assert mattermost.settings["files"] == [("upload.png", PNG)]
+
+
+@pytest.mark.parametrize(
+    "batch",
+    [{"message": "Not a list"}, [{"message": "No channel"}], [{"attachments": "!"}]],
+)
+def test_invalid_batch(service, mattermost, batch):
+    (response,) = post(service, dict(url="batch", json=batch))
+    assert response.status_code == 400
+    assert not mattermost.settings["posts"]
+
+
+@pytest.fixture
+def channel_limit(monkeypatch):
+    """Allow two posts per channel, then one every two seconds."""
+    monkeypatch.setattr(jupyterpost, "_channel_rate", 0.5)
+    monkeypatch.setattr(jupyterpost, "_channel_burst", 2)
+    monkeypatch.setattr(jupyterpost, "_channel_max_wait", 0)
+
+
+def test_channel_rate_limit(service, mattermost, channel_limit):
+    batch = [{"message": str(i), "channel": "town-square"} for i in range(4)]
+    batch.insert(1, {"message": "other", "channel": "off-topic"})
+    batch_response, other, limited = post(
+        service,
+        dict(url="batch", json=batch),
+        message(channel="off-topic"),
+        message(),
+    )
+    results = batch_response.json()
+    assert [result.get("retry_after") for result in results] == [None] * 3 + [2] * 2
+    assert all("post_id" in result for result in results[:3])
+    assert other.status_code == 200
+    assert limited.status_code == 429
+    assert limited.headers["Retry-After"] == "2"
+    assert len(mattermost.settings["posts"]) == 4
+
+
+def test_streamed_post_over_channel_rate_limit(service, mattermost, channel_limit):
+    files = [("file", ("plot.png", PNG))] * 2
+    responses = post(service, *(message(files=files) for _ in range(3)))
+    assert [r.status_code for r in responses] == [200, 200, 429]
+    # The refused post uploaded nothing
+    assert len(mattermost.settings["files"]) == 4
+    assert mattermost.settings["stats"]["files"] == 4
+
+
+def test_refused_posts_are_not_counted(service, mattermost, monkeypatch):
+    monkeypatch.setattr(jupyterpost, "_user_post_limit", SlidingWindow(3, 60))
+    mattermost.settings["missing"].add("nowhere")
+    batch = [
+        {"message": "posted", "channel": "town-square"},
+        {"message": "lost", "channel": "nowhere"},
+    ]
+    responses = post(
+        service,
+        *[message(channel="nowhere")] * 3,
+        dict(url="batch", json=batch),
+        *[message()] * 3,
+    )
+    assert [r.status_code for r in responses] == [400] * 3 + [200] * 3 + [429]
+    assert len(mattermost.settings["posts"]) == 3
+
+
+def test_chunked_upload_over_byte_limit(service, mattermost, monkeypatch):
+    monkeypatch.setattr(jupyterpost, "_user_byte_limit", SlidingWindow(50_000, 60))
+    request = httpx.Request(
+        "POST",
+        "http://jupyterpost.invalid/",
+        data={"channel": "town-square", "message": "Plot"},
+        files={"file": ("plot.png", PNG)},
+    )
+    body = request.read()
+
+    async def chunks():
+        for i in range(0, len(body), 2**14):
+            yield body[i : i + 2**14]
+
+    headers = {"Content-Type": request.headers["Content-Type"]}
+    (response,) = post(service, dict(content=chunks(), headers=headers))
+    # Refused although the body does not announce its length
+    assert response.status_code == 429
+    assert not mattermost.settings["files"]
+    assert not mattermost.settings["posts"]
+
+
+@pytest.fixture
+def coalescer(monkeypatch):
+    """A coalescer posting directly, its window is ended by flush_all."""
+    monkeypatch.setenv("JUPYTERPOST_COALESCE_WINDOW", "60")
+    return jupyterpost.open_coalescer()
+
+
+def test_coalesced_posts(service, mattermost, coalescer):
+    files = [("file", ("plot.png", PNG))]
+
+    async def run():
+        async with service(coalescer=coalescer) as client:
+            for text in ("first", "second"):
+                request = message(text, files=files)
+                request["data"]["coalesce"] = "1"
+                response = await client.post("", **request)
+                assert response.json() == {"status": "coalesced"}
+            await coalescer.flush_all()
+
+    asyncio.run(run())
+    (posted,) = mattermost.settings["posts"]
+    assert posted["message"] == "*@alice (via jupyterpost)*: first\nsecond"
+    assert len(posted["file_ids"]) == 2
+
+
+def test_coalesce_after_attachments(service, mattermost, coalescer):
+    body = multipart(
+        ("channel", None, b"town-square"),
+        ("message", None, b"Plot"),
+        ("file", "plot.png", PNG),
+        ("coalesce", None, b"1"),
+    )
+    headers = {"Content-Type": f"multipart/form-data; boundary={BOUNDARY.decode()}"}
+    request = dict(content=body, headers=headers)
+    (response,) = post(service, request, coalescer=coalescer)
+    # The attachment was streamed already and cannot be merged
+    assert response.status_code == 400
+    assert "must come before the attachments" in response.text
+    assert not mattermost.settings["posts"]
+
+
+def test_queued_post_with_lost_answer(service, mattermost, tmp_path, monkeypatch):
+    monkeypatch.setenv("JUPYTERPOST_QUEUE_PATH", str(tmp_path / "queue.db"))
+    outbox = jupyterpost.open_outbox()
+    outbox.backoff = 0.01
+    mattermost.settings["post_faults"].append("lose")
+
+    async def run():
+        async with service(outbox=outbox) as client:
+            response = await client.post("", **message())
+            assert response.status_code == 202
+            url = f"status/{response.json()['queue_id']}"
+            worker = asyncio.ensure_future(outbox.run())
+            try:
+                while (status := (await client.get(url)).json())["status"] != "sent":
+                    await asyncio.sleep(0.01)
+            finally:
+                worker.cancel()
+            return status
+
+    status = asyncio.run(asyncio.wait_for(run(), 5))
+    # Sent again after the lost answer, but posted only once
+    assert status["attempts"] == 1
+    (posted,) = mattermost.settings["posts"]
+    assert status["post_id"] == posted["id"]
+    assert mattermost.settings["stats"]["repeated posts"] == 1
+
+
+def test_metrics(service, mattermost, tmp_path, monkeypatch):
+    monkeypatch.setenv("JUPYTERPOST_QUEUE_PATH", str(tmp_path / "queue.db"))
+    outbox = jupyterpost.open_outbox()
+
+    async def run():
+        async with service(outbox=outbox) as client:
+            await client.post("", **message())
+            await client.post("", data={"message": "No channel"})
+            return await client.get("metrics")
+
+    metrics = asyncio.run(run()).text
+    assert (
+        "jupyterpost_request_duration_seconds_count"
+        '{code="202",handler="ChatPostHandler",method="POST"}'
+    ) in metrics
+    assert 'jupyterpost_errors_total{code="400",origin="service"}' in metrics
+    assert "jupyterpost_queue_depth 1.0" in metrics
+    assert "jupyterhub_" not in metrics
+
+
+def test_transcoded_attachments(service, mattermost, monkeypatch):
+    Image = pytest.importorskip("PIL.Image")
+    monkeypatch.setenv("JUPYTERPOST_IMAGE_FORMAT", "webp")
+    data = BytesIO()
+    Image.new("RGB", (200, 100)).save(data, format="png")
+    files = [("file", ("plot.png", data.getvalue())), ("file", ("fake.png", PNG))]
+    (response,) = post(service, message(files=files))
+    assert response.status_code == 200
+    (webp, fake) = sorted(mattermost.settings["files"], reverse=True)
+    assert webp[0] == "plot.webp"
+    assert Image.open(BytesIO(webp[1])).format == "WEBP"
+    # Not an image that pillow understands, uploaded as is
+    assert fake == ("fake.png", PNG)
+
+
+def test_image_options_need_pillow(monkeypatch):
+    monkeypatch.setenv("JUPYTERHUB_SERVICE_PREFIX", "/services/jupyterpost/")
+    monkeypatch.setenv("JUPYTERPOST_IMAGE_FORMAT", "webp")
+    monkeypatch.setitem(sys.modules, "PIL", None)
+    # Refused on startup instead of failing every post with an image
+    with pytest.raises(SystemExit, match="needs pillow"):
+        jupyterpost.main()
+
+
+def test_image_format_is_checked(monkeypatch):
+    pytest.importorskip("PIL")
+    monkeypatch.setenv("JUPYTERHUB_SERVICE_PREFIX", "/services/jupyterpost/")
+    monkeypatch.setenv("JUPYTERPOST_IMAGE_FORMAT", "gif")
+    with pytest.raises(SystemExit, match="cannot convert images to gif"):
+        jupyterpost.main()